@@ -0,0 +1,41 @@
+"""
+    Times find_mir_match with a MirIndex on a simulated sam file for an increasing number of processes,
+    each counting a byte range chunk of the file. The speed up is bounded by the number of cores
+
+    Usage: python benchmarks/bench_find_mir_match.py [number of reads] [largest number of processes]
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_mir_index import write_sam_files
+from data_processing.read_counting import create_mir_index, find_mir_match
+
+def main(n_reads=1000000, max_processes=None):
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+    out_dir = tempfile.mkdtemp()
+    try:
+        mir_file, read_file = write_sam_files(out_dir, 2000, n_reads)
+        mir_index, mat_ids = create_mir_index(mir_file)
+        print("{} cores, {:.1f} MB sam file".format(multiprocessing.cpu_count(), os.path.getsize(read_file)/2.0**20))
+        print("{:>10}{:>12}{:>10}".format("processes", "time (s)", "speed up"))
+        serial = None
+        processes = 1
+        while processes <= max_processes:
+            start = time.time()
+            find_mir_match(read_file, mir_index, mat_ids, processes=processes, seed=0)
+            elapsed = time.time()-start
+            serial = serial or elapsed
+            print("{:>10}{:>12.3f}{:>10.2f}".format(processes, elapsed, serial/elapsed))
+            processes *= 2
+    finally:
+        shutil.rmtree(out_dir)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
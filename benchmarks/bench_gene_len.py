@@ -0,0 +1,100 @@
+"""
+    Times get_gene_len_gtf on simulated gtf files, and the previous per line regex parser
+    which filled the series of lengths one gene at a time for the sizes where it finishes in reasonable time
+
+    Usage: python benchmarks/bench_gene_len.py [largest number of genes]
+"""
+from __future__ import print_function
+
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import pandas as pd
+
+from data_processing.normalize import get_gene_len_gtf
+
+def write_gtf(f_name, n_genes, seed=0):
+    """
+        Writes a gtf file with gene, exon and CDS lines for overlapping transcripts of each gene
+    """
+    rand = random.Random(seed)
+    with open(f_name, "w") as fout:
+        fout.write("#!genome-build simulated\n")
+        for gene in range(n_genes):
+            chrom = "chr{}".format(rand.randint(1, 22))
+            base = rand.randint(1, 10**8)
+            attrs = 'gene_id "G{0}"; gene_type "protein_coding"; gene_name "N{0}";'.format(gene)
+            fout.write("\t".join([chrom, "sim", "gene", str(base), str(base+5000), ".", "+", ".", attrs]) + "\n")
+            for transcript in range(rand.randint(1, 4)):
+                for exon in range(rand.randint(1, 8)):
+                    start = base + rand.randint(0, 5000)
+                    end = start + rand.randint(50, 400)
+                    ex_attrs = 'gene_id "G{0}"; transcript_id "T{0}.{1}"; gene_name "N{0}"; exon_number {2};'.format(
+                        gene, transcript, exon)
+                    for feature in ("exon", "CDS"):
+                        fout.write("\t".join([chrom, "sim", feature, str(start), str(end), ".", "+", ".",
+                                              ex_attrs]) + "\n")
+
+def regex_gene_len(gtf_file):
+    """
+        get_gene_len_gtf as it was first written
+    """
+    with open(gtf_file, "r") as fin:
+        gene_name_re = re.compile('; gene_name "(.*?)";')
+        gene_exons = {}
+        for line in fin:
+            if line[0] == "#":
+                continue
+            ele = line.split("\t")
+            if ele[2] != "exon":
+                continue
+            gene_name = gene_name_re.search(ele[8]).group(1)
+            gene_exons.setdefault(gene_name, []).append((int(ele[3]), int(ele[4])))
+
+    gene_len = pd.Series(name="GeneLength", dtype=float)
+    for gene in gene_exons:
+        old_end = 0
+        length = 0
+        for start, end in sorted(gene_exons[gene]):
+            if old_end > start and end > old_end:
+                length += end - old_end
+                old_end = end
+            elif old_end > start and old_end >= end:
+                continue
+            else:
+                length += end - start
+                old_end = end
+        gene_len[gene] = length
+    return gene_len
+
+def main(max_genes=100000):
+    out_dir = tempfile.mkdtemp()
+    try:
+        print("{:>10}{:>12}{:>16}{:>14}".format("genes", "size (MB)", "streamed (s)", "regex (s)"))
+        n_genes = 1000
+        while n_genes <= max_genes:
+            gtf_file = os.path.join(out_dir, "genes.gtf")
+            write_gtf(gtf_file, n_genes)
+
+            start = time.time()
+            get_gene_len_gtf(gtf_file)
+            streamed = time.time()-start
+
+            if n_genes <= 10000:
+                start = time.time()
+                regex_gene_len(gtf_file)
+                regex = "{:.3f}".format(time.time()-start)
+            else:
+                regex = "-"
+            print("{:>10}{:>12.1f}{:>16.3f}{:>14}".format(n_genes, os.path.getsize(gtf_file)/2.0**20,
+                                                          streamed, regex))
+            n_genes *= 10
+    finally:
+        shutil.rmtree(out_dir)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,48 @@
+"""
+    Times import data_processing and the first use of a name from each module in a fresh interpreter,
+    against importing every module up front as the package used to
+
+    Usage: python benchmarks/bench_import.py [number of runs]
+"""
+from __future__ import print_function
+
+import subprocess
+import sys
+
+from data_processing import _EXPORTS
+
+TIMED = """
+import time
+start = time.time()
+{}
+print(time.time() - start)
+"""
+
+def time_code(code, runs):
+    """
+        Returns the best time of the code over the runs, each in a new interpreter,
+        or the last line of the error if it fails
+    """
+    times = []
+    for run in range(runs):
+        proc = subprocess.Popen([sys.executable, "-c", TIMED.format(code)], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        out, err = proc.communicate()
+        if proc.returncode:
+            return err.strip().split("\n")[-1]
+        times += [float(out)]
+    return "{:.3f}".format(min(times))
+
+def main(runs=5):
+    print("{:<40}{}".format("import", "time (s)"))
+    print("{:<40}{}".format("import data_processing", time_code("import data_processing", runs)))
+    for module, names in _EXPORTS.items():
+        code = "import data_processing; data_processing.{}".format(names[0])
+        print("{:<40}{}".format("data_processing." + names[0], time_code(code, runs)))
+    # every module as the star imports did, leaving out those which fail to import here
+    eager = "\n".join("try:\n    import data_processing.{}\nexcept Exception:\n    pass".format(module)
+                      for module in _EXPORTS)
+    print("{:<40}{}".format("every module", time_code(eager, runs)))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
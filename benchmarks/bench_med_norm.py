@@ -0,0 +1,44 @@
+"""
+    Times med_norm on simulated read count matrices from 10k to 1M genes, and the previous
+    row-wise geometric mean apply for the sizes where it finishes in reasonable time
+
+    Usage: python benchmarks/bench_med_norm.py [number of samples]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from scipy import stats
+from data_processing.normalize import med_norm
+
+def apply_med_norm(df):
+    """
+        Median normalization with a row-wise gmean apply, as med_norm was first written
+    """
+    div_df = df.div(df.apply(stats.mstats.gmean, axis=1), axis=0)
+    return df.div(div_df.median(axis=0), axis=1) + 1
+
+def main(n_samples=20):
+    rand = np.random.RandomState(0)
+    print("{:>10}{:>10}{:>14}{:>14}".format("genes", "samples", "med_norm (s)", "apply (s)"))
+    for n_genes in (10**4, 10**5, 10**6):
+        means = rand.gamma(0.5, 200, size=(n_genes, 1))
+        df = pd.DataFrame(rand.poisson(means, size=(n_genes, n_samples)))
+
+        start = time.time()
+        med_norm(df)
+        vectorized = time.time()-start
+
+        if n_genes <= 10**4:
+            start = time.time()
+            apply_med_norm(df)
+            applied = "{:.3f}".format(time.time()-start)
+        else:
+            applied = "-"
+        print("{:>10}{:>10}{:>14.3f}{:>14}".format(n_genes, n_samples, vectorized, applied))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,72 @@
+"""
+    Compares the per base dictionary from create_mir_dict with the interval index from
+    create_mir_index on simulated mature miRNA alignments and small RNA reads
+
+    Usage: python benchmarks/bench_mir_index.py [number of miRNAs] [number of reads]
+"""
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from data_processing.read_counting import create_mir_dict, create_mir_index, find_mir_match
+
+def write_sam_files(out_dir, n_mir, n_reads, seed=0):
+    """
+        Writes a mature miRNA sam file and a read sam file with reads around the miRNAs
+    """
+    rand = random.Random(seed)
+    mir_file = os.path.join(out_dir, "mature.sam")
+    read_file = os.path.join(out_dir, "reads.sam")
+    mirs = []
+    with open(mir_file, "w") as fout:
+        fout.write("@HD\tVN:1.0\n")
+        for i in range(n_mir):
+            chrom = "chr{}".format(rand.randint(1, 22))
+            pos = rand.randint(1, 10**8)
+            seq = "".join(rand.choice("ACGT") for _ in range(rand.randint(18, 25)))
+            fout.write("\t".join(["hsa-miR-{}".format(i), rand.choice(["0", "16"]), chrom, str(pos),
+                                  "255", "{}M".format(len(seq)), "*", "0", "0", seq, "*"]) + "\n")
+            mirs += [(chrom, pos)]
+    with open(read_file, "w") as fout:
+        fout.write("@HD\tVN:1.0\n")
+        for i in range(n_reads):
+            chrom, pos = rand.choice(mirs)
+            seq = "".join(rand.choice("ACGT") for _ in range(rand.randint(16, 30)))
+            fout.write("\t".join(["read{}".format(i), rand.choice(["0", "16", "4"]), chrom,
+                                  str(pos+rand.randint(-10, 10)), "255", "{}M".format(len(seq)),
+                                  "*", "0", "0", seq, "I"*len(seq)]) + "\n")
+    return mir_file, read_file
+
+def time_call(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time()-start
+
+def main(n_mir=2000, n_reads=200000):
+    out_dir = tempfile.mkdtemp()
+    try:
+        mir_file, read_file = write_sam_files(out_dir, n_mir, n_reads)
+
+        (chrom_dict, mat_ids), dict_build = time_call(create_mir_dict, mir_file)
+        (mir_index, mat_ids), index_build = time_call(create_mir_index, mir_file)
+        random.seed(0)
+        (dict_reads, dict_qc), dict_count = time_call(find_mir_match, read_file, chrom_dict, mat_ids)
+        random.seed(0)
+        (index_reads, index_qc), index_count = time_call(find_mir_match, read_file, mir_index, mat_ids)
+
+        n_keys = sum(len(strands[strand]) for strands in chrom_dict.values() for strand in strands)
+        print("{} mature miRNAs, {} reads".format(n_mir, n_reads))
+        print("{:<12}{:>12}{:>12}{:>12}".format("", "entries", "build (s)", "count (s)"))
+        print("{:<12}{:>12}{:>12.3f}{:>12.3f}".format("dictionary", n_keys, dict_build, dict_count))
+        print("{:<12}{:>12}{:>12.3f}{:>12.3f}".format("index", len(mir_index.starts), index_build, index_count))
+        print("Same counts: {}".format(dict_reads == index_reads and dict_qc == index_qc))
+    finally:
+        shutil.rmtree(out_dir)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
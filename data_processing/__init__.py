@@ -1,7 +1,71 @@
-from data_processing.edit_db import *
-from data_processing.dna_functions import *
-from data_processing.normalize import *
-from data_processing.fold_change import *
-from data_processing.make_venn import *
-from data_processing.trim_align import *
-from data_processing.read_counting import *
\ No newline at end of file
+"""
+    The modules of the package, and their dependencies, are only imported the first time one of their names
+    is used (PEP 562, Python 3.7+), so import data_processing does not load pandas, scipy, matplotlib or the
+    database drivers
+    The fold_change function hides the module of the same name, as it did with the star imports, so
+    from data_processing import fold_change gives the function and the module is only reachable with
+    importlib.import_module("data_processing.fold_change")
+"""
+import importlib
+import sys
+import types
+
+# public names of each module, in the order the modules were star imported
+_EXPORTS = {
+    "edit_db": ["DatabaseConnection"],
+    "dna_functions": ["rev_comp", "transcribe", "rev_trans", "dna_to_rna", "rna_to_dna", "pack_seqs", "unpack_seqs",
+                      "rev_comp_batch", "transcribe_batch", "rev_trans_batch", "dna_to_rna_batch", "rna_to_dna_batch"],
+    "normalize": ["med_size_factors", "med_norm", "rpm_norm_df", "rpm_norm_ser", "LENGTH_METHODS", "length_norm",
+                  "rpkm_norm", "get_gene_len_gtf", "effective_lengths", "GeneAnnotation", "load_gene_annotation",
+                  "tmm_norm_factors", "tmm_norm"],
+    "chunked_normalize": ["NORM_METHODS", "iter_count_chunks", "chunked_norm"],
+    "fold_change": ["log_fold_change", "fold_change", "compute_contrasts"],
+    "differential": ["DIFF_TESTS", "bh_adjust", "welch_ttest", "nb_size_factors", "nb_wald_test",
+                     "differential_test"],
+    "gene_scoring": ["score_guide_lfc", "score_genes"],
+    "make_venn": ["region_id", "overlap_regions", "HIGH_QUAL_DPI", "render_diagrams", "make_diagram"],
+    "trim_align": ["TrimAndAlign"],
+    "read_counting": ["create_mir_dict", "MirIndex", "create_mir_index", "load_mir_index", "find_mir_match",
+                      "count_mirna_batch", "count_sgrna", "count_sgrna_incremental", "create_sgrna_index",
+                      "count_sgrna_fastq"],
+    "sam_reader": ["FLAG_PAIRED", "FLAG_PROPER_PAIR", "FLAG_UNMAPPED", "FLAG_MATE_UNMAPPED", "FLAG_REVERSE",
+                   "FLAG_MATE_REVERSE", "FLAG_FIRST", "FLAG_SECOND", "FLAG_SECONDARY", "FLAG_QC_FAIL",
+                   "FLAG_DUPLICATE", "FLAG_SUPPLEMENTARY", "FLAG_NOT_PRIMARY", "is_gzip", "parse_sam_block",
+                   "read_sam_chunks", "is_bam", "parse_bam_block", "read_bam_chunks", "read_alignment_chunks"],
+    "gtf_reader": ["parse_gtf_block", "read_gtf_chunks", "union_lengths"],
+    "seq_store": ["SeqStore", "KmerIndex"],
+}
+
+# name: module, a later module overrides an earlier one as with the star imports
+_NAME_MODULES = dict((_name, _module) for _module, _names in _EXPORTS.items() for _name in _names)
+
+__all__ = sorted(_NAME_MODULES)
+
+# exported names which are also module names (fold_change)
+_SHADOWED = set(_NAME_MODULES) & set(_EXPORTS)
+
+class _Package(types.ModuleType):
+    """
+        Importing a module sets it as an attribute of the package, which would hide an exported name
+        of the same name, so those modules are not set and stay in sys.modules only
+    """
+    def __setattr__(self, name, value):
+        if name in _SHADOWED and isinstance(value, types.ModuleType):
+            return
+        types.ModuleType.__setattr__(self, name, value)
+
+sys.modules[__name__].__class__ = _Package
+
+def __getattr__(name):
+    if name in _NAME_MODULES:
+        value = getattr(importlib.import_module("data_processing." + _NAME_MODULES[name]), name)
+    elif name in _EXPORTS or name == "cache":
+        value = importlib.import_module("data_processing." + name)
+    else:
+        raise AttributeError("module 'data_processing' has no attribute '{}'".format(name))
+    # cached in the package so the next access does not come back here
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAME_MODULES) | set(_EXPORTS))
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+
+def get_cache_dir(cache_dir=None):
+    """
+        Returns the directory to keep cache files in and creates it if it does not exist
+        Uses cache_dir if given, otherwise the DATA_PROCESSING_CACHE environment variable
+        or ~/.cache/data_processing
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("DATA_PROCESSING_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "data_processing"))
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another process may have made it first
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+def file_digest(f_name, block_size=2**20):
+    """
+        Returns the sha1 hex digest of the contents of the file
+    """
+    sha = hashlib.sha1()
+    with open(f_name, "rb") as fin:
+        block = fin.read(block_size)
+        while block:
+            sha.update(block)
+            block = fin.read(block_size)
+    return sha.hexdigest()
+
+def cached_file_digest(f_name, cache_dir=None):
+    """
+        Returns the sha1 hex digest of the file like file_digest, but keeps the digest of each file with its
+        size and modified time in digests.json of the cache directory, so the file is only hashed again
+        when its size or modified time changed
+    """
+    digest_file = os.path.join(get_cache_dir(cache_dir), "digests.json")
+    path = os.path.abspath(f_name)
+    stat = os.stat(path)
+    digests = {}
+    if os.path.exists(digest_file):
+        try:
+            with open(digest_file, "r") as fin:
+                digests = json.load(fin)
+        except ValueError:
+            # a broken file is rebuilt
+            digests = {}
+    entry = digests.get(path)
+    if entry is not None and (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime):
+        return entry["sha1"]
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": file_digest(path)}
+    digests[path] = entry
+    # write to a temporary file first so other jobs never load a partial file
+    tmp_file = "{}.{}.tmp".format(digest_file, os.getpid())
+    with open(tmp_file, "w") as fout:
+        json.dump(digests, fout)
+    replace_file(tmp_file, digest_file)
+    return entry["sha1"]
+
+def replace_file(tmp_name, f_name):
+    """
+        Moves the finished temporary file to f_name, so other processes never read a partial cache file
+    """
+    if hasattr(os, "replace"):
+        os.replace(tmp_name, f_name)
+    else:
+        os.rename(tmp_name, f_name)
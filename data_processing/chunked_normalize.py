@@ -0,0 +1,224 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from data_processing.normalize import (LENGTH_METHODS, _gene_len_series, _length_col_div, _med_log_ratios,
+                                       _scale_dense, _tmm_factors, _tmm_ref_col)
+
+NORM_METHODS = ("med", "rpm", "tmm") + LENGTH_METHODS
+
+def iter_count_chunks(source, chunksize=100000, key="counts"):
+    """
+        Yields the read count matrix as dataframes of at most chunksize genes
+        Takes a csv file with gene names in the first column, an hdf5 file written in table format,
+        a .npy file, which is memory mapped, or a dataframe or numpy array already in memory
+
+        key [optional]: key of the table in an hdf5 file
+    """
+    if isinstance(source, pd.DataFrame):
+        for i in range(0, len(source), chunksize):
+            yield source.iloc[i:i+chunksize]
+    elif isinstance(source, np.ndarray) or source.endswith(".npy"):
+        if not isinstance(source, np.ndarray):
+            source = np.load(source, mmap_mode="r")
+        for i in range(0, source.shape[0], chunksize):
+            chunk = np.asarray(source[i:i+chunksize])
+            yield pd.DataFrame(chunk, index=np.arange(i, i+chunk.shape[0]))
+    elif source.endswith((".h5", ".hdf5")):
+        for chunk in pd.read_hdf(source, key, chunksize=chunksize):
+            yield chunk
+    else:
+        for chunk in pd.read_csv(source, index_col=0, chunksize=chunksize):
+            yield chunk
+
+class _ChunkWriter(object):
+    """
+        Writes normalized chunks one after another to a .npy memory map, an hdf5 table,
+        a parquet file (needs pyarrow) or a csv file, picked by the extension of out_file
+    """
+    def __init__(self, out_file, n_genes, n_samples, dtype=np.float64, key="counts"):
+        self.out_file = out_file
+        self.key = key
+        self.dtype = dtype
+        self.row = 0
+        self.out = None
+        if out_file.endswith(".npy"):
+            self.kind = "npy"
+            self.out = np.lib.format.open_memmap(out_file, mode="w+", dtype=dtype, shape=(n_genes, n_samples))
+        elif out_file.endswith((".h5", ".hdf5")):
+            self.kind = "hdf"
+            self.out = pd.HDFStore(out_file, mode="w")
+        elif out_file.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+            self.kind = "parquet"
+            self.pa = pyarrow
+        else:
+            self.kind = "csv"
+            self.out = open(out_file, "w")
+
+    def write(self, chunk_df):
+        if self.kind == "npy":
+            self.out[self.row:self.row+len(chunk_df)] = chunk_df.values
+        elif self.kind == "hdf":
+            self.out.append(self.key, chunk_df)
+        elif self.kind == "parquet":
+            # parquet column names have to be strings
+            chunk_df.columns = [str(col) for col in chunk_df.columns]
+            table = self.pa.Table.from_pandas(chunk_df)
+            if self.out is None:
+                self.out = self.pa.parquet.ParquetWriter(self.out_file, table.schema)
+            self.out.write_table(table)
+        else:
+            chunk_df.to_csv(self.out, header=self.row == 0)
+        self.row += len(chunk_df)
+
+    def close(self):
+        if self.kind == "npy":
+            self.out.flush()
+            del self.out
+        elif self.out is not None:
+            self.out.close()
+
+def _column(mm, col):
+    """
+        Reads one column of the on disk matrix into memory
+    """
+    return np.array(mm[:, col], dtype=float)
+
+def _chunk_gene_len(gene_len, chunk, row, effective):
+    """
+        Returns the gene lengths of the chunk starting at row, by position from an array of lengths in row order
+        or by gene name otherwise
+    """
+    if isinstance(gene_len, np.ndarray):
+        chunk_len = gene_len[row:row+len(chunk)]
+        if len(chunk_len) < len(chunk):
+            raise ValueError("gene_len has {} lengths, fewer than the genes of the read counts".format(len(gene_len)))
+        return chunk_len
+    return _gene_len_series(gene_len, chunk.index, effective).values
+
+def chunked_norm(source, out_file, method="med", gene_len=None, ref_samp=None, trim_fc_perc=30,
+                 trim_abs_perc=5, chunksize=100000, key="counts", tmp_dir=None, dtype=np.float64, effective=False):
+    """
+        Normalizes a read count matrix too large to hold in memory in two passes over chunks of genes
+        The first pass adds up the reads in each sample and keeps what the size factors need in a temporary
+        file, the second pass writes each normalized chunk to out_file, so memory use depends on chunksize
+        and the number of genes in one sample, not the size of the matrix
+        Gives the same values as med_norm, rpm_norm_df, length_norm and tmm_norm
+
+        source: csv file, hdf5 table, .npy file, dataframe or numpy array of read counts (see iter_count_chunks)
+        out_file: .npy, .h5/.hdf5, .parquet or .csv file to write the normalized read counts to,
+                  gene names are not kept in a .npy file, the rows stay in the input order
+        method [optional]: "med", "rpm", "tmm", "rpkm", "fpkm" or "tpm"
+        gene_len [optional]: series, csv file or GeneAnnotation of gene lengths, needed for "rpkm", "fpkm" and "tpm",
+                             or a numpy array of lengths in row order, which a .npy file or numpy array needs
+                             as it has no gene names
+        ref_samp [optional]: reference sample column name for "tmm"
+        tmp_dir [optional]: directory for the temporary files of the first pass
+        dtype [optional]: data type of the normalized read counts, ie numpy.float32 to halve the output size
+        effective [optional]: uses the effective lengths of a GeneAnnotation
+
+        Returns the series of size factors for "med", normalization factors for "tmm", number of reads
+        in each sample for "rpm", "rpkm" and "fpkm" or reads per kilobase in each sample for "tpm"
+    """
+    if method not in NORM_METHODS:
+        raise ValueError("method must be one of {}, not '{}'".format(", ".join(NORM_METHODS), method))
+    if method in LENGTH_METHODS:
+        if gene_len is None:
+            raise ValueError("{} normalization needs gene lengths".format(method))
+        if isinstance(gene_len, (np.ndarray, list, tuple)):
+            if effective:
+                raise ValueError("Effective lengths need a GeneAnnotation with effective lengths")
+            gene_len = np.asarray(gene_len, dtype=float)
+        elif isinstance(source, np.ndarray) or (isinstance(source, str) and source.endswith(".npy")):
+            # the chunks are indexed by row number, which gene names can't be matched to
+            raise ValueError("A .npy file or numpy array has no gene names, gene_len must be a numpy array "
+                             "of gene lengths in row order")
+        elif isinstance(gene_len, str):
+            gene_len = _gene_len_series(gene_len)
+
+    tmp_fd, tmp_name = tempfile.mkstemp(suffix=".dat", dir=tmp_dir)
+    try:
+        # First pass, number of reads in each sample and the genes the size factors are calculated from
+        columns = None
+        lib_size = 0
+        rate_size = 0
+        sqrt_sums = 0
+        n_genes = 0
+        n_kept = 0
+        with os.fdopen(tmp_fd, "wb") as tmp_out:
+            for chunk in iter_count_chunks(source, chunksize, key):
+                counts = chunk.values.astype(float)
+                columns = chunk.columns
+                lib_size = lib_size + counts.sum(axis=0)
+                if method == "tpm":
+                    # reads per kilobase in each sample
+                    chunk_len = _chunk_gene_len(gene_len, chunk, n_genes, effective)
+                    rate_size = rate_size + _length_col_div(counts, chunk_len, method)*1000000.0
+                n_genes += counts.shape[0]
+                if method == "med":
+                    kept = _med_log_ratios(counts)
+                elif method == "tmm":
+                    # remove genes with no reads in any sample
+                    kept = counts[(counts > 0).any(axis=1)]
+                    sqrt_sums = sqrt_sums + np.sqrt(kept).sum(axis=0)
+                else:
+                    continue
+                kept.tofile(tmp_out)
+                n_kept += kept.shape[0]
+        if columns is None:
+            raise ValueError("No read counts in {}".format(source))
+        if isinstance(gene_len, np.ndarray) and len(gene_len) != n_genes:
+            raise ValueError("gene_len has {} lengths for {} genes".format(len(gene_len), n_genes))
+
+        if method in ("med", "tmm"):
+            if not n_kept:
+                raise ValueError("No genes to calculate the size factors from in {}".format(source))
+            kept = np.memmap(tmp_name, dtype=float, mode="r", shape=(n_kept, len(columns)))
+        if method == "med":
+            # Gets the median of the log ratio of read number to geometric mean for each sample
+            log_factors = np.array([np.median(_column(kept, col)) for col in range(len(columns))])
+            factors = pd.Series(np.exp(log_factors), index=columns)
+            scale = factors.values
+        elif method == "tmm":
+            if ref_samp is None:
+                upper_quart = np.array([np.percentile(_column(kept, col), 75) for col in range(len(columns))])
+                ref_col = _tmm_ref_col(upper_quart, sqrt_sums, lib_size)
+            else:
+                ref_col = columns.get_loc(ref_samp)
+            ref = _column(kept, ref_col)
+            factors = np.array([_tmm_factors(_column(kept, col)[:, np.newaxis], ref, lib_size[[col]],
+                                             lib_size[ref_col], trim_fc_perc, trim_abs_perc)[0]
+                                for col in range(len(columns))])
+            # to make factors multiply to one, divide by geometric mean
+            factors = pd.Series(factors/np.exp(np.mean(np.log(factors))), index=columns)
+            scale = lib_size*factors.values/1000000.0
+        elif method == "tpm":
+            factors = pd.Series(rate_size, index=columns)
+            scale = rate_size/1000000.0
+        else:
+            factors = pd.Series(lib_size, index=columns)
+            scale = lib_size/1000000.0
+        if method in ("med", "tmm"):
+            del kept
+
+        # Second pass, normalizes each chunk and writes it out
+        writer = _ChunkWriter(out_file, n_genes, len(columns), dtype, key)
+        try:
+            row = 0
+            for chunk in iter_count_chunks(source, chunksize, key):
+                if method in LENGTH_METHODS:
+                    chunk_len = _chunk_gene_len(gene_len, chunk, row, effective)/1000.0
+                    normed = _scale_dense(chunk.values, scale, chunk_len, dtype=dtype)
+                else:
+                    normed = _scale_dense(chunk.values, scale, pseudocount=0 if method == "tmm" else 1,
+                                          dtype=dtype)
+                writer.write(pd.DataFrame(normed, index=chunk.index, columns=columns, copy=False))
+                row += len(chunk)
+        finally:
+            writer.close()
+    finally:
+        os.remove(tmp_name)
+    return factors
@@ -0,0 +1,187 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from scipy import special
+
+from data_processing.fold_change import _columns
+from data_processing.normalize import med_size_factors, tmm_norm_factors
+
+DIFF_TESTS = ("nb_wald", "welch")
+
+def bh_adjust(pvalues):
+    """
+        Benjamini-Hochberg adjusts the p-values for the false discovery rate
+        NaN p-values stay NaN and are not counted as tests
+    """
+    p = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+    tested = ~np.isnan(p)
+    n_tests = tested.sum()
+    # from the largest p-value down, the adjusted p-value is the smallest p*n/rank so far
+    order = np.argsort(p[tested])[::-1]
+    ranked = p[tested][order]*n_tests/np.arange(n_tests, 0, -1)
+    tested_adj = np.empty(n_tests)
+    tested_adj[order] = np.minimum(np.minimum.accumulate(ranked), 1)
+    adjusted[tested] = tested_adj
+    if isinstance(pvalues, pd.Series):
+        return pd.Series(adjusted, index=pvalues.index, name=pvalues.name)
+    return adjusted
+
+def welch_ttest(df, controls, experimentals):
+    """
+        Welch's unequal variance t-test of every gene (row) between the control and experimental columns
+        Takes values on the scale they should be compared on, ie log2 of normalized read counts
+        Needs at least 2 columns in each group
+
+        Returns a dataframe of the difference of means (experimental - control), t, degrees of freedom,
+        p-value and Benjamini-Hochberg adjusted p-value
+    """
+    values = df.values.astype(float)
+    groups = [values[:, _columns(df, cols)] for cols in (controls, experimentals)]
+    if min(group.shape[1] for group in groups) < 2:
+        raise ValueError("Welch's t-test needs at least 2 control and 2 experimental columns")
+    n_c, n_e = [group.shape[1] for group in groups]
+    mean_c, mean_e = [group.mean(axis=1) for group in groups]
+    # variance of the mean of each group
+    var_c, var_e = [group.var(axis=1, ddof=1)/group.shape[1] for group in groups]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (mean_e - mean_c)/np.sqrt(var_c + var_e)
+        dof = (var_c + var_e)**2/(var_c**2/(n_c-1) + var_e**2/(n_e-1))
+        pvalue = 2*special.stdtr(dof, -np.abs(t))
+    return pd.DataFrame({"diff": mean_e - mean_c, "t": t, "df": dof, "pvalue": pvalue,
+                         "padj": bh_adjust(pvalue)}, index=df.index)
+
+def nb_size_factors(df, norm="med"):
+    """
+        Returns the size factor of each sample for the negative binomial test, scaled to multiply to one
+        norm is "med" for the median of ratios size factors (med_norm) or "tmm" for the number of reads
+        times the TMM normalization factor (tmm_norm)
+    """
+    if norm == "med":
+        return med_size_factors(df)
+    if norm == "tmm":
+        size = np.asarray(df.sum(axis=0), dtype=float)*tmm_norm_factors(df).values
+        return pd.Series(size/np.exp(np.mean(np.log(size))), index=df.columns)
+    raise ValueError("norm must be 'med' or 'tmm', not '{}'".format(norm))
+
+def _dispersion_trend(base_mean, dispersion, n_iter=10):
+    """
+        Fits the trend dispersion = a + b/mean to the gene-wise dispersions by least squares, as the
+        parametric fit of DESeq, leaving out genes far from the fit and refitting until it settles
+    """
+    use = (base_mean > 0) & (dispersion > 1e-7)
+    coefs = np.array([0.1, 1.0])
+    if use.sum() < 3:
+        return np.full(len(base_mean), np.nan)
+    design = np.column_stack([np.ones(len(base_mean)), 1.0/np.where(base_mean > 0, base_mean, np.inf)])
+    for i in range(n_iter):
+        new_coefs = np.linalg.lstsq(design[use], dispersion[use], rcond=None)[0]
+        new_coefs = np.maximum(new_coefs, 1e-8)
+        fit = design.dot(new_coefs)
+        use = (base_mean > 0) & (dispersion > 1e-7) & (dispersion/fit < 15)
+        if np.allclose(new_coefs, coefs, rtol=1e-3):
+            break
+        coefs = new_coefs
+    return design.dot(coefs)
+
+def nb_wald_test(df, controls, experimentals, size_factors=None, norm="med", dispersion=None):
+    """
+        Negative binomial Wald test of every gene (row) of read counts between the control and experimental columns
+        The mean of each group is its number of reads over the sum of its size factors, with 0.5 added so
+        genes without reads in one group still get a finite fold change
+        The dispersion of each gene is estimated from the within group variance of the normalized read counts
+        (method of moments) and raised to the fitted mean-dispersion trend, as DESeq's "maximum" sharing mode,
+        since a handful of replicates gives noisy gene-wise dispersions, unless it is given
+
+        size_factors [optional]: series of size factors of each column, ie from med_norm(df, return_factors=True),
+                                 otherwise calculated with nb_size_factors
+        norm [optional]: "med" or "tmm" size factors if size_factors is not given
+        dispersion [optional]: one dispersion, or an array with one for each gene
+
+        Returns a dataframe of the mean normalized read count, log2 fold change, its standard error,
+        Wald statistic, p-value, Benjamini-Hochberg adjusted p-value and dispersion
+    """
+    if size_factors is None:
+        size_factors = nb_size_factors(df, norm)
+    counts = df.values.astype(float)
+    size_factors = np.asarray(pd.Series(size_factors).reindex(df.columns).values, dtype=float)
+    group_cols = [_columns(df, cols) for cols in (controls, experimentals)]
+    norm_counts = counts/size_factors
+
+    means = []
+    for cols in group_cols:
+        means += [(counts[:, cols].sum(axis=1) + 0.5)/size_factors[cols].sum()]
+    if dispersion is None:
+        # pooled within group variance of the normalized read counts, minus the poisson part
+        resid = sum(((norm_counts[:, cols] - norm_counts[:, cols].mean(axis=1)[:, np.newaxis])**2).sum(axis=1)
+                    for cols in group_cols)
+        n_samples = sum(len(cols) for cols in group_cols)
+        all_cols = np.concatenate(group_cols)
+        base_mean = norm_counts[:, all_cols].mean(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var = resid/max(n_samples - len(group_cols), 1)
+            dispersion = (var - base_mean*np.mean(1.0/size_factors[all_cols]))/base_mean**2
+        dispersion = np.where(np.isfinite(dispersion), np.maximum(dispersion, 1e-8), 1e-8)
+        trend = _dispersion_trend(base_mean, dispersion)
+        dispersion = np.where(np.isfinite(trend), np.maximum(dispersion, trend), dispersion)
+    dispersion = np.broadcast_to(np.asarray(dispersion, dtype=float), (len(df),))
+
+    # fisher information of the log mean of each group
+    variances = []
+    for cols, mean in zip(group_cols, means):
+        mu = mean[:, np.newaxis]*size_factors[cols]
+        variances += [1.0/(mu/(1 + dispersion[:, np.newaxis]*mu)).sum(axis=1)]
+    log_fc = np.log(means[1]/means[0])
+    se = np.sqrt(variances[0] + variances[1])
+    stat = log_fc/se
+    pvalue = special.erfc(np.abs(stat)/np.sqrt(2))
+    return pd.DataFrame({"baseMean": norm_counts[:, np.concatenate(group_cols)].mean(axis=1),
+                         "log2FC": log_fc/np.log(2), "lfcSE": se/np.log(2), "stat": stat, "pvalue": pvalue,
+                         "padj": bh_adjust(pvalue), "dispersion": dispersion}, index=df.index)
+
+_worker_test = None
+
+def _init_test_worker(df, test, kwargs):
+    global _worker_test
+    _worker_test = (df, test, kwargs)
+
+def _test_worker(contrast):
+    df, test, kwargs = _worker_test
+    controls, experimentals = contrast
+    if test == "welch":
+        return welch_ttest(df, controls, experimentals)
+    return nb_wald_test(df, controls, experimentals, **kwargs)
+
+def differential_test(df, contrasts, test="nb_wald", processes=1, **kwargs):
+    """
+        Tests every gene for differential abundance in each contrast, in parallel across contrasts
+
+        df: pandas dataframe of read counts for "nb_wald", or log scale values for "welch"
+        contrasts: dictionary of contrast name: (list of control columns, list of experimental columns),
+                   as in compute_contrasts
+        test [optional]: "nb_wald" (nb_wald_test) or "welch" (welch_ttest)
+        processes [optional]: number of contrasts to test at the same time
+        kwargs: passed on to nb_wald_test. The size factors are calculated once from every column
+                for all contrasts unless given
+
+        Returns a dataframe with a (contrast name, statistic) column multiindex
+    """
+    if test not in DIFF_TESTS:
+        raise ValueError("test must be one of {}, not '{}'".format(", ".join(DIFF_TESTS), test))
+    if test == "nb_wald" and kwargs.get("size_factors") is None:
+        kwargs["size_factors"] = nb_size_factors(df, kwargs.pop("norm", "med"))
+
+    contrast_list = list(contrasts.values())
+    if processes > 1 and len(contrast_list) > 1:
+        pool = multiprocessing.Pool(min(processes, len(contrast_list)), initializer=_init_test_worker,
+                                    initargs=(df, test, kwargs))
+        try:
+            results = pool.map(_test_worker, contrast_list)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_test_worker(df, test, kwargs)
+        results = [_test_worker(contrast) for contrast in contrast_list]
+    return pd.concat(results, axis=1, keys=list(contrasts))
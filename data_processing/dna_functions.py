@@ -1,41 +1,166 @@
-from string import maketrans
+# character mappings of the sequence functions
+_REV_COMP = ("ATCGUatcgu", "TAGCAtagca")
+_TRANSCRIBE = ("ATCGatcg", "UAGCuagc")
+_REV_TRANS = ("AUCGaucg", "TAGCtagc")
+_DNA_TO_RNA = ("Tt", "Uu")
+_RNA_TO_DNA = ("Uu", "Tt")
+
+# translation tables of the single sequence functions
+_REV_COMP_TABLE = str.maketrans(*_REV_COMP)
+_TRANSCRIBE_TABLE = str.maketrans(*_TRANSCRIBE)
+_REV_TRANS_TABLE = str.maketrans(*_REV_TRANS)
+_DNA_TO_RNA_TABLE = str.maketrans(*_DNA_TO_RNA)
+_RNA_TO_DNA_TABLE = str.maketrans(*_RNA_TO_DNA)
+
+# lookup tables of the batch functions by mapping, made on first use so the single sequence functions
+# do not load numpy
+_BYTE_LUTS = {}
+
+def _byte_lut(mapping):
+    """
+        Returns the 256 byte lookup table of the (old, new) mapping, which maps each character of old
+        to the one of new and leaves the rest
+    """
+    import numpy as np
+    if mapping not in _BYTE_LUTS:
+        old, new = mapping
+        lut = np.arange(256, dtype=np.uint8)
+        lut[np.frombuffer(old.encode(), dtype=np.uint8)] = np.frombuffer(new.encode(), dtype=np.uint8)
+        _BYTE_LUTS[mapping] = lut
+    return _BYTE_LUTS[mapping]
 
 def rev_comp(seq):
     """
         Reverse complements the passed in DNA or RNA sequence
     """
-    t = maketrans("ATCGUatcgu", "TAGCAtagca")
-    new_seq = seq.translate(t)[::-1]
+    new_seq = seq.translate(_REV_COMP_TABLE)[::-1]
     return new_seq
 
 def transcribe(seq):
     """
         Transcribes a DNA sequence into RNA
     """
-    t = maketrans("ATCGatcg", "UAGCuagc")
-    new_seq = seq.translate(t)[::-1]
+    new_seq = seq.translate(_TRANSCRIBE_TABLE)[::-1]
     return new_seq
 
 def rev_trans(seq):
     """
         Reverse transcribes a RNA sequence into DNA
     """
-    t = maketrans("AUCGaucg", "TAGCtagc")
-    new_seq = seq.translate(t)[::-1]
+    new_seq = seq.translate(_REV_TRANS_TABLE)[::-1]
     return new_seq
 
 def dna_to_rna(seq):
     """
         Directly converts DNA to RNA by replacing T with U
     """
-    new_seq = seq.replace("t", "u")
-    new_seq = new_seq.replace("T", "U")
+    new_seq = seq.translate(_DNA_TO_RNA_TABLE)
     return new_seq
 
 def rna_to_dna(seq):
     """
         Directly converts RNA to DNA by replacing U with T
     """
-    new_seq = seq.replace("u", "t")
-    new_seq = new_seq.replace("U", "T")
-    return new_seq
\ No newline at end of file
+    new_seq = seq.translate(_RNA_TO_DNA_TABLE)
+    return new_seq
+
+def pack_seqs(seqs):
+    """
+        Packs a list of sequences (strings or bytes) into a fixed width uint8 array of one row per sequence,
+        shorter sequences are padded at the end with 0
+    """
+    import numpy as np
+    packed = np.array(seqs, dtype=np.bytes_)
+    if not packed.dtype.itemsize:
+        packed = packed.astype("S1")
+    return packed.view(np.uint8).reshape(len(packed), packed.dtype.itemsize)
+
+def unpack_seqs(packed, as_bytes=False):
+    """
+        Returns the list of sequences (strings, or bytes if as_bytes) of a fixed width uint8 array
+        of one row per sequence, without the 0 padding
+    """
+    import numpy as np
+    packed = np.ascontiguousarray(packed, dtype=np.uint8)
+    seqs = packed.view("S{}".format(max(packed.shape[1], 1))).ravel()
+    if as_bytes:
+        return seqs.tolist()
+    return seqs.astype(str).tolist()
+
+def _reverse_rows(packed):
+    """
+        Reverses each row of a fixed width uint8 array, only over the sequence so the 0 padding stays at the end
+    """
+    import numpy as np
+    is_seq = packed != 0
+    if is_seq.all():
+        return packed[:, ::-1]
+    # the sequence bytes in row order, reversed, are every sequence reversed with the last one first,
+    # so they fill the rows from the last up
+    rev = np.zeros_like(packed)
+    rev[is_seq[::-1]] = packed[is_seq][::-1]
+    return rev[::-1]
+
+def _translate_list(seqs, lut, reverse):
+    """
+        Translates (and reverses) a list of sequences joined into one array, reversing the joined sequences
+        reverses each sequence and their order
+    """
+    import numpy as np
+    as_bytes = isinstance(seqs[0], bytes)
+    joined = b"".join(seqs) if as_bytes else "".join(seqs).encode("ascii")
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    flat = np.frombuffer(joined, dtype=np.uint8)
+    if reverse:
+        flat = flat[::-1]
+        lengths = lengths[::-1]
+    new = lut[flat].tobytes()
+    if not as_bytes:
+        new = new.decode("ascii")
+    ends = np.cumsum(lengths).tolist()
+    new_seqs = [new[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    return new_seqs[::-1] if reverse else new_seqs
+
+def _translate_batch(seqs, lut, reverse):
+    """
+        Translates (and reverses) every sequence of the batch at once with the lookup table
+        Takes a list of sequences or a fixed width uint8 array (see pack_seqs) and returns the same
+    """
+    import numpy as np
+    if not (isinstance(seqs, np.ndarray) and seqs.dtype == np.uint8):
+        seqs = list(seqs)
+        return _translate_list(seqs, lut, reverse) if seqs else []
+    packed = seqs if seqs.ndim == 2 else seqs[np.newaxis, :]
+    if reverse:
+        packed = _reverse_rows(packed)
+    return lut[packed].reshape(seqs.shape)
+
+def rev_comp_batch(seqs):
+    """
+        Reverse complements every DNA or RNA sequence of a list or fixed width uint8 array at once
+    """
+    return _translate_batch(seqs, _byte_lut(_REV_COMP), True)
+
+def transcribe_batch(seqs):
+    """
+        Transcribes every DNA sequence of a list or fixed width uint8 array into RNA at once
+    """
+    return _translate_batch(seqs, _byte_lut(_TRANSCRIBE), True)
+
+def rev_trans_batch(seqs):
+    """
+        Reverse transcribes every RNA sequence of a list or fixed width uint8 array into DNA at once
+    """
+    return _translate_batch(seqs, _byte_lut(_REV_TRANS), True)
+
+def dna_to_rna_batch(seqs):
+    """
+        Directly converts every DNA sequence of a list or fixed width uint8 array to RNA at once
+    """
+    return _translate_batch(seqs, _byte_lut(_DNA_TO_RNA), False)
+
+def rna_to_dna_batch(seqs):
+    """
+        Directly converts every RNA sequence of a list or fixed width uint8 array to DNA at once
+    """
+    return _translate_batch(seqs, _byte_lut(_RNA_TO_DNA), False)
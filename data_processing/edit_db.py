@@ -102,7 +102,7 @@ class DatabaseConnection:
             self.connection = pyodbc.connect(connection_string)
             self.server = None
         else:
-            print "Error: Please enter valid sql_version (MySQL or MSSQL)"
+            print("Error: Please enter valid sql_version (MySQL or MSSQL)")
     
     def load_config(self):
         """
@@ -167,26 +167,26 @@ WHERE TABLE_NAME = '{}' AND TABLE_SCHEMA = '{}';
         cursor = self.get_cursor()
 
         if self.check_table_exists(table_name):
-            drop_in = raw_input("The table {} already exists. Would you like to drop and recreate it? (Y/N)".format(table_name))
+            drop_in = input("The table {} already exists. Would you like to drop and recreate it? (Y/N)".format(table_name))
             # Make sure input is only N or Y
             while True:
                 if drop_in.upper() == "N" or drop_in.upper() == "Y":
                     break
                 else:
-                    drop_in = raw_input("""PLEASE ENTER Y or N. The table {} already exists. 
+                    drop_in = input("""PLEASE ENTER Y or N. The table {} already exists. 
             Would you like to drop and recreate it? (Y/N)""".format(table_name))
             if drop_in.upper() == "N":
-                print "No new table created"
+                print("No new table created")
                 return False
             elif drop_in.upper() == "Y":
-                print "Deleting table {}".format(table_name)
+                print("Deleting table {}".format(table_name))
                 deleted = self.delete_table(table_name)
                 if deleted:
-                    print "Table {} sucessfully deleted".format(table_name)
+                    print("Table {} sucessfully deleted".format(table_name))
                 else:
-                    print "Table {} was not deleted".format(table_name)
+                    print("Table {} was not deleted".format(table_name))
                     return False
-        print "Creating table {}".format(table_name)
+        print("Creating table {}".format(table_name))
         columns_list = []
         for key in columns_dict:
             cond = columns_dict[key]
@@ -200,11 +200,11 @@ WHERE TABLE_NAME = '{}' AND TABLE_SCHEMA = '{}';
             create_str = "CREATE TABLE {} ({}) ENGINE=InnoDB;".format(table_name, column_str)
         else:
             create_str = "CREATE TABLE {} ({});".format(table_name, column_str)
-        print create_str
+        print(create_str)
         success = self.excute_with_error_check(create_str)
 
         if success:
-            print "Sucessfully created table {}".format(table_name)
+            print("Sucessfully created table {}".format(table_name))
 
         return True
 
@@ -247,7 +247,7 @@ ke.REFERENCED_TABLE_NAME LIKE '{}' AND ke.REFERENCED_TABLE_SCHEMA ='{}{}';""".fo
             connection.commit()
             return True
         else:
-            drop_fk = raw_input("""The table(s) {} have foreign key contstrants on table {}. 
+            drop_fk = input("""The table(s) {} have foreign key contstrants on table {}. 
 It is necessary to drop these tables to drop {}. 
 Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, table, table))
             # Make sure input is only N or Y
@@ -255,7 +255,7 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
                 if drop_fk.upper() == "N" or drop_fk.upper() == "Y":
                     break
                 else:
-                    drop_fk = raw_input("""PLEASE ENTER Y or N. The tables {} have foreign key contstrants on table {}. 
+                    drop_fk = input("""PLEASE ENTER Y or N. The tables {} have foreign key contstrants on table {}. 
 It is necessary to drop these tables to drop {}. 
 Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, table, table))
             if drop_fk.upper() == "N":
@@ -284,7 +284,7 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
                 connection.commit()
                 return True
             except pyodbc.ProgrammingError:
-                print "Could not execute string {}".format(execute_str)
+                print("Could not execute string {}".format(execute_str))
                 return False
         else:
             try:
@@ -293,10 +293,10 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
                 return True
             except mysql.connector.Error as err:
                 if err.errno == errorcode.ER_TABLE_EXISTS_ERROR:
-                    print "Table already exits"
+                    print("Table already exits")
                     return False
                 else:
-                    print err.msg
+                    print(err.msg)
                     return False
 
     def clear_table(self, table):
@@ -381,14 +381,14 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
         connection, server = self.get_connection()
         cursor = self.get_cursor()
 
-        columns = insert_dict.keys()
-        values_list = insert_dict.values()
+        columns = list(insert_dict.keys())
+        values_list = list(insert_dict.values())
 
         # check to make sure length is the same
         len_val = len(values_list[0])
         same_len = all(len(x)==len_val for x in values_list)
         if not same_len:
-            print "The list of values to be inserted are of unequal length"
+            print("The list of values to be inserted are of unequal length")
             return False
         # split lists if length longer than 950
         num_chunk = math.ceil(len_val/MAX_VAL)
@@ -464,11 +464,11 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
         cursor = self.get_cursor()
 
         # check to make sure length is the same
-        len_val = len(update_dict[update_dict.keys()[0]])
+        len_val = len(update_dict[list(update_dict.keys())[0]])
         same_len = all(len(val)==len_val for key, val in update_dict.items())
         cond_len = all(len(val)==len_val for key, val in condition_dict.items())
         if not same_len or not cond_len:
-            print "The list of updates and/or conditions are of unequal length"
+            print("The list of updates and/or conditions are of unequal length")
             return False
         
         num_chunk = int(math.ceil(len_val/float(CHUNK_SIZE)))
@@ -476,15 +476,15 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
             chunk_start = i*CHUNK_SIZE
             chunk_end = min(i*CHUNK_SIZE+CHUNK_SIZE, len_val)
             chunk_update = {}
-            for key, val in update_dict.iteritems():
+            for key, val in update_dict.items():
                 chunk_update[key] = val[chunk_start:chunk_end]
             chunk_condition = {}
-            for key, val in condition_dict.iteritems():
+            for key, val in condition_dict.items():
                 chunk_condition[key] = val[chunk_start:chunk_end]
 
             # SET clause formating    
             update_list = []
-            for key, val_list in chunk_update.iteritems():
+            for key, val_list in chunk_update.items():
                 set_list = []
                 for i in range(len(val_list)):
                     val = val_list[i]
@@ -503,7 +503,7 @@ Would you like to continue and drop these tables? (Y/N)""".format(fk_tables, tab
 
             # WHERE clause formatting
             condition_list = []
-            for key, val_list in chunk_condition.iteritems():
+            for key, val_list in chunk_condition.items():
                 val_list = [str(self.format_value(val)) for val in val_list]
                 val_str = ",".join(val_list)
                 condition_list += ["{} IN ({})".format(key, val_str)]
@@ -1,7 +1,42 @@
-import math
+import numpy as np
 import pandas as pd
 
-def log_fold_change(df, control_list, experimental_col):
+def _columns(df, cols):
+    """
+        Returns the positions of the column name or list of column names in the dataframe
+    """
+    if isinstance(cols, (list, tuple, pd.Index, np.ndarray)):
+        positions = np.asarray(df.columns.get_indexer(cols))
+        if (positions == -1).any():
+            # get_indexer gives -1 for a missing name, which would index the last column
+            raise KeyError("{} not in index".format([col for col, pos in zip(cols, positions) if pos == -1]))
+        return positions
+    return np.array([df.columns.get_loc(cols)])
+
+def _ratio(df, control_list, experimental_col, pseudocount):
+    """
+        Returns the numpy array of the experimental column(s) plus the pseudocount divided by the
+        average of control columns plus the pseudocount, and the experimental column names
+    """
+    # only the selected columns are converted, so other columns (ie gene names) can be of any type
+    control = df.iloc[:, _columns(df, control_list)].to_numpy(dtype=float).mean(axis=1) + pseudocount
+    exper = df.iloc[:, _columns(df, experimental_col)].to_numpy(dtype=float, copy=True)
+    if pseudocount:
+        exper += pseudocount
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exper /= control[:, np.newaxis]
+    return exper
+
+def _like_selection(df, values, experimental_col):
+    """
+        Wraps the values in a series for a single experimental column or a dataframe for a list of them,
+        as df.loc[:, experimental_col] would be
+    """
+    if isinstance(experimental_col, (list, tuple, pd.Index, np.ndarray)):
+        return pd.DataFrame(values, index=df.index, columns=experimental_col)
+    return pd.Series(values[:, 0], index=df.index, name=experimental_col)
+
+def log_fold_change(df, control_list, experimental_col, pseudocount=0):
     """
         Calculates the log2 fold change between experimental column(s) and
         the average of control columns and returns dataframe
@@ -9,17 +44,15 @@ def log_fold_change(df, control_list, experimental_col):
         df: pandas dataframe with values
         control_list: list of columns to use as base
         experimental_col: column name or list of columns to calculate fold change of
+        pseudocount [optional]: added to the experimental values and control average before the ratio,
+                                with the default of 0 a zero gives -inf or inf instead of an error
     """
-    controlSer = df.loc[:,control_list].mean(axis=1)
-    experDF = df.loc[:,experimental_col]
-    fcDF = experDF.div(controlSer, axis=0)
-    if isinstance(fcDF, pd.DataFrame):
-        fcDF= fcDF.applymap(lambda x: math.log(x,2))
-    else:
-        fcDF= fcDF.apply(lambda x: math.log(x,2))
-    return fcDF
+    ratio = _ratio(df, control_list, experimental_col, pseudocount)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.log2(ratio, out=ratio)
+    return _like_selection(df, ratio, experimental_col)
 
-def fold_change(df, control_list, experimental_col):
+def fold_change(df, control_list, experimental_col, pseudocount=0):
     """
         Calculates the fold change between experimental column and
         the average of control columns and returns series
@@ -27,8 +60,38 @@ def fold_change(df, control_list, experimental_col):
         df: pandas dataframe with values
         control_list: list of columns to use as base
         experimental_col: column name or list of columns to calculate fold change of
+        pseudocount [optional]: added to the experimental values and control average before the ratio
+    """
+    return _like_selection(df, _ratio(df, control_list, experimental_col, pseudocount), experimental_col)
+
+def compute_contrasts(df, contrasts, pseudocount=1, log=True):
+    """
+        Calculates the log2 fold change (or fold change) of many contrasts over the same dataframe at once
+        The average of each group of columns is calculated once and shared by every contrast which uses it,
+        and the fold changes are written into a single array
+
+        df: pandas dataframe with values
+        contrasts: dictionary of contrast name: (list of control columns, experimental column or list of columns),
+                   the fold change is between the averages of the experimental and control columns
+        pseudocount [optional]: added to the averages before the ratio
+        log [optional]: returns log2 fold changes, otherwise fold changes
+
+        Returns a dataframe with a column for each contrast
     """
-    controlSer = df.loc[:, control_list].mean(axis=1)
-    exper = df.loc[:, experimental_col]
-    fc = exper.div(controlSer)
-    return fc
\ No newline at end of file
+    group_means = {}
+    out = np.empty((len(df), len(contrasts)), order="F")
+    for i, (controls, experimentals) in enumerate(contrasts.values()):
+        means = []
+        for group in (controls, experimentals):
+            positions = _columns(df, group)
+            group_key = tuple(positions)
+            if group_key not in group_means:
+                # the average of a group plus the pseudocount is calculated once for every contrast
+                group_means[group_key] = df.iloc[:, positions].to_numpy(dtype=float).mean(axis=1) + pseudocount
+            means += [group_means[group_key]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(means[1], means[0], out=out[:, i])
+    if log:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.log2(out, out=out)
+    return pd.DataFrame(out, index=df.index, columns=list(contrasts), copy=False)
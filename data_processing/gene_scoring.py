@@ -0,0 +1,162 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from scipy import special
+
+from data_processing.differential import bh_adjust
+from data_processing.fold_change import compute_contrasts
+from data_processing.normalize import med_norm
+
+def _group_starts(sizes):
+    """
+        Returns the first position of each group of a gene sorted array from the group sizes
+    """
+    return np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+def _sorted_medians(values, sizes):
+    """
+        Returns the median of each group of a gene then value sorted array
+    """
+    starts = _group_starts(sizes)
+    return (values[starts + (sizes-1)//2] + values[starts + sizes//2])/2.0
+
+def _rra_rho(sorted_ranks, sizes):
+    """
+        Robust rank aggregation score of each group of a gene then rank sorted array of normalized ranks:
+        the smallest probability that the k-th smallest of n uniform ranks is at most the k-th rank of the gene
+    """
+    starts = _group_starts(sizes)
+    n = np.repeat(sizes, sizes)
+    k = np.arange(len(sorted_ranks)) - np.repeat(starts, sizes) + 1
+    return np.minimum.reduceat(special.betainc(k, n-k+1, sorted_ranks), starts)
+
+# number of random guide sets drawn at once, each block of sets has its own seed
+_PERM_BATCH = 1000
+
+def _null_block(lfc, size, n_sets, seed=None):
+    """
+        Draws n_sets random sets of size different guides and returns their robust rank aggregation scores and
+        median log fold changes
+        The guides of every set are drawn at once with Floyd's algorithm, one guide of each set at a time
+    """
+    rand = np.random.RandomState(seed)
+    n_guides = len(lfc)
+    picks = np.empty((n_sets, size), dtype=np.int64)
+    for i, last in enumerate(range(n_guides - size, n_guides)):
+        pick = rand.randint(last + 1, size=n_sets)
+        # a guide already in the set is replaced by last, which can not be in it yet
+        taken = (picks[:, :i] == pick[:, np.newaxis]).any(axis=1)
+        picks[:, i] = np.where(taken, last, pick)
+    picks.sort(axis=1)
+    # guides are sorted by log fold change, so the guide positions are the ranks
+    flat_sizes = np.full(n_sets, size)
+    return (_rra_rho(((picks + 1.0)/n_guides).ravel(), flat_sizes),
+            _sorted_medians(lfc[picks].ravel(), flat_sizes))
+
+_worker_lfc = None
+
+def _init_perm_worker(lfc):
+    global _worker_lfc
+    _worker_lfc = lfc
+
+def _null_block_worker(args):
+    size, n_sets, seed = args
+    return _null_block(_worker_lfc, size, n_sets, seed)
+
+def score_guide_lfc(guide_lfc, guide_genes, n_perm=10000, direction="neg", processes=1, seed=None):
+    """
+        Scores each gene from the log fold changes of its guides: the median log fold change and the robust rank
+        aggregation score of the guide ranks, each with a permutation p-value and Benjamini-Hochberg FDR
+        The null scores depend only on the number of guides of a gene, so they are drawn once for each
+        gene size, from sets of different guides, in blocks of sets split between processes
+
+        guide_lfc: series of log fold changes indexed by guide
+        guide_genes: series or dictionary of guide: gene, guides without a gene are left out
+        n_perm [optional]: number of random guide sets drawn for each gene size
+        direction [optional]: "neg" ranks the most depleted guides first, "pos" the most enriched
+        processes [optional]: number of processes to draw the random guide sets with
+        seed [optional]: seed of the random guide sets, for the same p-values on every run with any number
+                         of processes
+
+        Returns a dataframe indexed by gene, sorted by robust rank aggregation score
+    """
+    if direction not in ("neg", "pos"):
+        raise ValueError("direction must be 'neg' or 'pos', not '{}'".format(direction))
+    genes = pd.Series(guide_genes).reindex(guide_lfc.index)
+    keep = genes.notnull().values & np.isfinite(guide_lfc.values)
+    lfc = guide_lfc.values[keep].astype(float)
+    gene_names, gene_codes = np.unique(genes.values[keep].astype(str), return_inverse=True)
+
+    # ranks normalized to 0-1, most depleted (or enriched) guide first
+    signed = lfc if direction == "neg" else -lfc
+    rank_order = np.argsort(signed, kind="mergesort")
+    ranks = np.empty(len(lfc))
+    ranks[rank_order] = (np.arange(len(lfc)) + 1.0)/len(lfc)
+
+    sizes = np.bincount(gene_codes)
+    by_lfc = np.lexsort((lfc, gene_codes))
+    median_lfc = _sorted_medians(lfc[by_lfc], sizes)
+    by_rank = np.lexsort((ranks, gene_codes))
+    rho = _rra_rho(ranks[by_rank], sizes)
+
+    # each block of random guide sets is seeded with the seed, gene size and block number,
+    # so the p-values do not depend on the number of processes
+    uniq_sizes = np.unique(sizes)
+    sorted_signed = np.sort(signed)
+    blocks = [(int(size), min(_PERM_BATCH, n_perm - first), None if seed is None else [seed, int(size), block])
+              for size in uniq_sizes for block, first in enumerate(range(0, n_perm, _PERM_BATCH))]
+    if processes > 1 and len(blocks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(blocks)), initializer=_init_perm_worker,
+                                    initargs=(sorted_signed,))
+        try:
+            results = pool.map(_null_block_worker, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_perm_worker(sorted_signed)
+        results = [_null_block_worker(block) for block in blocks]
+    null_rhos, null_medians = {}, {}
+    for (size, _, _), (block_rho, block_median) in zip(blocks, results):
+        null_rhos.setdefault(size, []).append(block_rho)
+        null_medians.setdefault(size, []).append(block_median)
+
+    rho_pvalue = np.empty(len(sizes))
+    median_pvalue = np.empty(len(sizes))
+    signed_median = median_lfc if direction == "neg" else -median_lfc
+    for size in uniq_sizes:
+        in_size = sizes == size
+        null_rho = np.sort(np.concatenate(null_rhos[size]))
+        null_median = np.sort(np.concatenate(null_medians[size]))
+        # one is added to count the observed score as one of the random ones
+        rho_pvalue[in_size] = (np.searchsorted(null_rho, rho[in_size], side="right") + 1.0)/(n_perm + 1)
+        median_pvalue[in_size] = (np.searchsorted(null_median, signed_median[in_size], side="right") + 1.0)/(n_perm + 1)
+
+    scores = pd.DataFrame({"n_guides": sizes, "median_lfc": median_lfc, "median_pvalue": median_pvalue,
+                           "median_fdr": bh_adjust(median_pvalue), "rra_score": rho, "rra_pvalue": rho_pvalue,
+                           "rra_fdr": bh_adjust(rho_pvalue)}, index=pd.Index(gene_names, name="Gene"))
+    return scores.sort_values("rra_score", kind="mergesort")
+
+def score_genes(count_df, guide_genes, controls, experimentals, n_perm=10000, direction="neg", pseudocount=1,
+                normalize=True, processes=1, seed=None):
+    """
+        Scores each gene from the read counts of its guides, ie from count_sgrna
+        Guide log2 fold changes between the averages of the experimental and control columns are calculated
+        with compute_contrasts and scored with score_guide_lfc
+
+        count_df: pandas dataframe of guide read counts
+        guide_genes: series or dictionary of guide: gene
+        controls: list of control columns
+        experimentals: experimental column or list of columns
+        pseudocount [optional]: added to the averages before the log fold change
+        normalize [optional]: median normalizes the read counts first (med_norm without a pseudocount)
+
+        Returns the gene score dataframe of score_guide_lfc with the guide log fold changes added as an attribute
+    """
+    if normalize:
+        count_df = med_norm(count_df, pseudocount=0)
+    guide_lfc = compute_contrasts(count_df, {"lfc": (controls, experimentals)}, pseudocount)["lfc"]
+    scores = score_guide_lfc(guide_lfc, guide_genes, n_perm, direction, processes, seed)
+    scores.attrs["guide_lfc"] = guide_lfc
+    return scores
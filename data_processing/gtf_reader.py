@@ -0,0 +1,131 @@
+import gzip
+import numpy as np
+
+from data_processing.sam_reader import _field_ints, _field_strings, is_gzip
+
+def _find_next(buf, starts, char, max_len=4096):
+    """
+        Returns the offset of the first char at or after each start in the byte array,
+        stepping forward only for the starts which have not found it yet
+    """
+    found = np.full(len(starts), -1, dtype=np.int64)
+    pos = starts.copy()
+    todo = np.arange(len(starts))
+    for i in range(max_len):
+        if not len(todo):
+            break
+        pos = np.minimum(pos, len(buf)-1)
+        is_char = buf[pos] == char
+        found[todo[is_char]] = pos[is_char]
+        todo, pos = todo[~is_char], pos[~is_char] + 1
+    return found
+
+def parse_gtf_block(data, feature="exon", attributes=("gene_name",)):
+    """
+        Parses a block of complete gtf lines into a dictionary of column arrays: seqname, strand (bytes arrays),
+        start, end (integer arrays) and one bytes array for each attribute (empty if the line does not have it)
+        Only lines of the feature type are kept, which is checked before any attribute is parsed
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == 10)
+    line_starts = np.concatenate(([0], line_ends[:-1]+1))
+    tabs = np.flatnonzero(buf == 9)
+    first_tab = np.searchsorted(tabs, line_starts)
+    n_tabs = np.searchsorted(tabs, line_ends) - first_tab
+
+    # gtf lines have 9 columns, comment lines start with #
+    keep = n_tabs >= 8
+    keep[keep] = buf[line_starts[keep]] != ord("#")
+    line_starts = line_starts[keep]
+    line_ends = line_ends[keep]
+    first_tab = first_tab[keep]
+
+    # the feature column is compared as a whole before the attributes are looked at
+    feature = feature.encode() if not isinstance(feature, bytes) else feature
+    feat_start, feat_end = tabs[first_tab+1]+1, tabs[first_tab+2]
+    is_feature = feat_end - feat_start == len(feature)
+    for i, char in enumerate(bytearray(feature)):
+        is_feature[is_feature] = buf[feat_start[is_feature]+i] == char
+    line_starts = line_starts[is_feature]
+    line_ends = line_ends[is_feature]
+    first_tab = first_tab[is_feature]
+
+    chunk = {"seqname": _field_strings(buf, line_starts, tabs[first_tab]),
+             "start": _field_ints(buf, tabs[first_tab+2]+1, tabs[first_tab+3]),
+             "end": _field_ints(buf, tabs[first_tab+3]+1, tabs[first_tab+4]),
+             "strand": _field_strings(buf, tabs[first_tab+5]+1, tabs[first_tab+6])}
+
+    attr_starts = tabs[first_tab+7]+1
+    # the attribute column of only the lines of the feature type, sliced from the block since
+    # it is too wide to gather byte by byte
+    attr_col = np.array([data[start:end] for start, end in zip(attr_starts.tolist(), line_ends.tolist())]
+                        or [b""])[:len(line_starts)]
+    for attribute in attributes:
+        name = attribute.encode() if not isinstance(attribute, bytes) else attribute
+        # each attribute is 'name "value";', the name has to start the attribute,
+        # so 'gene_name' does not match 'ref_gene_name'
+        found = np.char.find(attr_col, name + b' "')
+        wrong = (found > 0)
+        wrong[wrong] = ~np.isin(buf[attr_starts[wrong] + found[wrong] - 1], (32, 59))
+        while wrong.any():
+            found[wrong] = np.char.find(attr_col[wrong], name + b' "', found[wrong] + 1)
+            again = found[wrong] > 0
+            again[again] = ~np.isin(buf[attr_starts[wrong][again] + found[wrong][again] - 1], (32, 59))
+            wrong[wrong] = again
+        has_attr = found >= 0
+        starts = np.zeros(len(line_starts), dtype=np.int64)
+        ends = np.zeros(len(line_starts), dtype=np.int64)
+        starts[has_attr] = attr_starts[has_attr] + found[has_attr] + len(name) + 2
+        ends[has_attr] = np.maximum(_find_next(buf, starts[has_attr], ord('"')), starts[has_attr])
+        chunk[attribute] = _field_strings(buf, starts, ends)
+    return chunk
+
+def read_gtf_chunks(gtf_file, feature="exon", attributes=("gene_name",), chunk_size=2**22):
+    """
+        Streams the gtf file and yields dictionaries of column arrays (see parse_gtf_block)
+        for about chunk_size bytes of lines at a time. Gzipped gtf files are read transparently
+    """
+    fin = gzip.open(gtf_file, "rb") if is_gzip(gtf_file) else open(gtf_file, "rb")
+    try:
+        rest = b""
+        while True:
+            block = fin.read(chunk_size)
+            if not block:
+                if rest:
+                    yield parse_gtf_block(rest + b"\n", feature, attributes)
+                break
+            block = rest + block
+            last_line = block.rfind(b"\n") + 1
+            rest = block[last_line:]
+            if last_line:
+                yield parse_gtf_block(block[:last_line], feature, attributes)
+    finally:
+        fin.close()
+
+def union_lengths(keys, starts, ends, seqnames=None):
+    """
+        Adds together the lengths of the half open (start, end) intervals of each key minus any overlap
+        Intervals are sorted by key, seqname and start and swept once, keeping the running maximum end
+        of each key and seqname, so intervals on different seqnames are never merged
+        Returns the sorted unique keys and their lengths
+    """
+    uniq_keys, key_codes = np.unique(keys, return_inverse=True)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if seqnames is None:
+        group_codes = key_codes
+    else:
+        _, seq_codes = np.unique(seqnames, return_inverse=True)
+        group_codes = key_codes*(seq_codes.max()+1 if len(seq_codes) else 1) + seq_codes
+    order = np.lexsort((starts, group_codes))
+    group_codes, key_codes, starts, ends = group_codes[order], key_codes[order], starts[order], ends[order]
+
+    # running maximum end within each group, made with one cumulative max by offsetting every group
+    # above the ends of the groups before it
+    offset = group_codes*(int(ends.max()) + 1 if len(ends) else 1)
+    prev_end = np.maximum.accumulate(ends + offset) - offset
+    prev_end = np.concatenate(([0], prev_end[:-1]))
+    prev_end[np.concatenate(([True], group_codes[1:] != group_codes[:-1]))] = 0
+    # only the part of the interval past the end of the intervals before it adds to the length
+    added = np.maximum(ends - np.maximum(starts, prev_end), 0)
+    return uniq_keys, np.bincount(key_codes, weights=added, minlength=len(uniq_keys)).astype(np.int64)
@@ -1,12 +1,182 @@
-import matplotlib.pyplot as plt
-import pandas as pd
+import multiprocessing
 
-from matplotlib_venn import venn2, venn3
+from collections import OrderedDict
+
+def _value_masks(group_list):
+    """
+        Returns an ordered dictionary of value: bitmask of the groups it is in (bit i for group i),
+        in the order the values are first seen
+    """
+    masks = OrderedDict()
+    for i, group in enumerate(group_list):
+        bit = 1 << i
+        for value in group:
+            masks[value] = masks.get(value, 0) | bit
+    return masks
+
+def region_id(mask, n_groups):
+    """
+        Returns the id of the region of the bitmask, one character per group which is "1" if the
+        region is in the group, as the subset ids of matplotlib_venn ("10", "01", "11" for 2 groups)
+    """
+    return "".join("1" if mask >> i & 1 else "0" for i in range(n_groups))
+
+def overlap_regions(group_list):
+    """
+        Splits the values of any number of groups into the regions of their venn diagram in one pass,
+        by the bitmask of the groups each value is in. A value repeated in a group is counted once
+
+        group_list: list of lists (or any iterables) of values in the given group
+
+        Returns an ordered dictionary of region id (see region_id): list of values of only the non-empty regions,
+        in bitmask order (the subset order of venn2 and venn3) with the values in the order they are first seen
+    """
+    regions = {}
+    for value, mask in _value_masks(group_list).items():
+        regions.setdefault(mask, []).append(value)
+    n_groups = len(group_list)
+    return OrderedDict((region_id(mask, n_groups), regions[mask]) for mask in sorted(regions))
+
+HIGH_QUAL_DPI = 800
+
+def _new_canvas(figsize):
+    """
+        Returns an Agg canvas of a new figure, drawn without pyplot so no figure manager keeps it alive
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    return FigureCanvasAgg(Figure(figsize=figsize))
+
+def _draw_venn(fig, regions, name_list, n_groups):
+    """
+        Draws the venn diagram of 2 or 3 groups from their regions and returns its axes
+    """
+    from matplotlib_venn import venn2, venn3
+
+    # subsets in the order of venn2 and venn3: 10, 01, 11 and 100, 010, 110, 001, 101, 011, 111
+    subsets = tuple(len(regions.get(region_id(mask, n_groups), [])) for mask in range(1, 2**n_groups))
+    ax = fig.add_subplot(1, 1, 1)
+    if n_groups == 2:
+        venn2(ax=ax, subsets=subsets, set_labels=(name_list[0], name_list[1]))
+    else:
+        venn3(ax=ax, subsets=subsets, set_labels=(name_list[0], name_list[1], name_list[2]))
+    return ax
+
+def _draw_upset(fig, regions, name_list, group_sizes, max_regions=30):
+    """
+        Draws an UpSet plot of the largest regions: a bar of the size of each region above a matrix of
+        dots marking the groups it is in, and a bar of the size of each group to the left
+        Returns the axes of the region sizes
+    """
+    from matplotlib.gridspec import GridSpec
+
+    n_groups = len(group_sizes)
+    region_ids = sorted(regions, key=lambda region: -len(regions[region]))[:max_regions]
+    region_sizes = [len(regions[region]) for region in region_ids]
+    grid = GridSpec(2, 2, figure=fig, width_ratios=(1, 3), height_ratios=(2, 1), wspace=0.3, hspace=0.05)
+    bars = fig.add_subplot(grid[0, 1])
+    matrix = fig.add_subplot(grid[1, 1], sharex=bars)
+    totals = fig.add_subplot(grid[1, 0], sharey=matrix)
+
+    bars.bar(range(len(region_ids)), region_sizes, width=0.6, color="black")
+    for x, size in enumerate(region_sizes):
+        bars.text(x, size, str(size), ha="center", va="bottom", fontsize=6)
+    bars.set_ylabel("Intersection size")
+    bars.tick_params(axis="x", bottom=False, labelbottom=False)
+
+    # a grey dot for each group, black for the groups in the region, joined by a line
+    # drawn as one scatter of each color and one line broken by NaNs for every region
+    in_x, in_y, line_x, line_y = [], [], [], []
+    for x, region in enumerate(region_ids):
+        inside = [i for i in range(n_groups) if region[i] == "1"]
+        in_x += [x]*len(inside)
+        in_y += inside
+        line_x += [x, x, float("nan")]
+        line_y += [inside[0], inside[-1], float("nan")]
+    matrix.scatter([x for x in range(len(region_ids)) for i in range(n_groups)],
+                   list(range(n_groups))*len(region_ids), s=40, color="lightgray")
+    matrix.plot(line_x, line_y, lw=2, color="black")
+    matrix.scatter(in_x, in_y, s=40, color="black", zorder=3)
+    matrix.set_xlim(-0.5, len(region_ids)-0.5)
+    matrix.set_ylim(n_groups-0.5, -0.5)
+    matrix.set_xticks([])
+    matrix.set_yticks(range(n_groups))
+    matrix.set_yticklabels(name_list[:n_groups])
+    for spine in matrix.spines.values():
+        spine.set_visible(False)
+
+    totals.barh(range(n_groups), group_sizes, height=0.6, color="black")
+    totals.invert_xaxis()
+    totals.set_xlabel("Set size")
+    totals.tick_params(axis="y", left=False, labelleft=False)
+    return bars
+
+def _render(canvas, job, dpi):
+    """
+        Clears the figure of the canvas, draws the venn diagram (2 or 3 groups) or UpSet plot (more groups)
+        of the job and saves it. Returns the overlap regions
+    """
+    group_list, name_list, title, output_file = job
+    fig = canvas.figure
+    fig.clf()
+    regions = overlap_regions(group_list)
+    if len(group_list) > 3:
+        group_sizes = [sum(len(values) for region, values in regions.items() if region[i] == "1")
+                       for i in range(len(group_list))]
+        ax = _draw_upset(fig, regions, name_list, group_sizes)
+    else:
+        ax = _draw_venn(fig, regions, name_list, len(group_list))
+    ax.set_title(title)
+
+    # the tight bounding box is measured with the renderer at the figure resolution, so the figure
+    # is only rasterized once at the output resolution
+    bbox = fig.get_tightbbox(canvas.get_renderer()).padded(0.1)
+    fig.savefig(output_file, dpi=dpi, bbox_inches=bbox)
+    return regions
+
+_worker_render = None
+
+def _init_render_worker(figsize, dpi):
+    global _worker_render
+    _worker_render = (_new_canvas(figsize), dpi)
+
+def _render_worker(job):
+    canvas, dpi = _worker_render
+    return _render(canvas, job, dpi)
+
+def render_diagrams(jobs, figsize=(8, 6), high_qual=False, processes=1):
+    """
+        Draws and saves many venn diagrams, or UpSet plots for more than 3 groups, through one reused
+        Agg figure in each process instead of a new pyplot figure for each diagram
+
+        jobs: list of (group_list, name_list, title, output_file), as the arguments of make_diagram
+        figsize [optional]: size (in inches) of the figures
+        high_qual [optional]: saves higher quality (800 dpi) figures
+        processes [optional]: number of processes to draw the diagrams with
+
+        Returns the overlap regions (see overlap_regions) of each job
+    """
+    jobs = [tuple(job) for job in jobs]
+    for group_list, name_list, title, output_file in jobs:
+        if len(group_list) < 2:
+            raise ValueError("{} needs at least 2 groups, not {}".format(output_file, len(group_list)))
+    dpi = HIGH_QUAL_DPI if high_qual else "figure"
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)), initializer=_init_render_worker,
+                                    initargs=(figsize, dpi))
+        try:
+            return pool.map(_render_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    _init_render_worker(figsize, dpi)
+    return [_render_worker(job) for job in jobs]
 
 def make_diagram(group_list, name_list, title, output_file, return_names=False,
                  figsize=(8, 6), high_qual=False):
     """
-        Makes venn diagram
+        Makes venn diagram, or an UpSet plot for more than 3 groups
+        Drawn with render_diagrams, matplotlib is only loaded to draw it
 
         group_list: list of lists of values in the given group
         name_list: list of names for each group
@@ -16,45 +186,13 @@ def make_diagram(group_list, name_list, title, output_file, return_names=False,
         figsize [optional]: size (in inches) of figure
         high_qual [optional]: returns a higher quality (800 dpi) figure
     """
-    fig, ax = plt.subplots(1,1, figsize=figsize)
-
-    # if we are only comparing two groups
-    if len(group_list) == 2: 
-        group_one_only = [x for x in group_list[0] if x not in group_list[1]]
-        group_two_only = [x for x in group_list[1] if x not in group_list[0]]
-        both = [x for x in group_list[0] if x in group_list[1]]
-
-        venn2(ax=ax, subsets=(len(group_one_only), len(group_two_only), len(both)),
-              set_labels=(name_list[0], name_list[1]))
-
-    elif len(group_list) == 3:
-        group_one_only = [x for x in group_list[0] if x not in group_list[1] and x not in group_list[2]]
-        group_two_only = [x for x in group_list[1] if x not in group_list[0] and x not in group_list[2]]
-        group_one_two = [x for x in group_list[0] if x in group_list[1] and x not in group_list[2]]
-        group_three_only = [x for x in group_list[2] if x not in group_list[1] and x not in group_list[0]]
-        group_one_three = [x for x in group_list[0] if x not in group_list[1] and x in group_list[2]]
-        group_two_three = [x for x in group_list[1] if x not in group_list[0] and x in group_list[2]]
-        all_groups = [x for x in group_list[0] if x in group_list[1] and x in group_list[2]]
-        
-        venn3(ax=ax, subsets=(len(group_one_only), len(group_two_only), len(group_one_two), len(group_three_only),
-                              len(group_one_three), len(group_two_three), len(all_groups)), 
-              set_labels=(name_list[0], name_list[1], name_list[2]))
-    else:
-        print "Error: please enter a condition list with 2 or 3 conditions"
+    if len(group_list) < 2:
+        print("Error: please enter a condition list with at least 2 conditions")
         return
 
-    ax.set_title(title)
-
-    if high_qual:
-        plt.savefig(output_file, bbox_inches="tight", dpi=800)
-    else:
-        plt.savefig(output_file, bbox_inches="tight")
-    plt.close()
+    regions = render_diagrams([(group_list, name_list, title, output_file)], figsize, high_qual)[0]
 
     if return_names:
-        if len(group_list) == 2:
-            return both
-        else:
-            return all_groups
+        return regions.get("1"*len(group_list), [])
     else:
         return
@@ -1,166 +1,576 @@
-import math # has log function
-import re
+import os
+import numpy as np
 import pandas as pd 
 
-from scipy import stats # has geometric mean function
+from scipy import sparse
 
-def med_norm(df):
+from data_processing.cache import cached_file_digest, get_cache_dir, replace_file
+from data_processing.gtf_reader import read_gtf_chunks, union_lengths
+
+def _sparse_counts(df):
+    """
+        Returns the read counts as a scipy sparse csc matrix, the row names and the column names
+        if df is a scipy sparse matrix (no names) or a dataframe of sparse columns, otherwise None
+    """
+    if sparse.issparse(df):
+        counts = sparse.csc_matrix(df, dtype=float)
+        index = columns = None
+    elif (isinstance(df, pd.DataFrame) and len(df.columns) and
+          all(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes)):
+        counts = sparse.csc_matrix(df.sparse.to_coo(), dtype=float)
+        index, columns = df.index, df.columns
+    else:
+        return None
+    # explicitly stored zeros would be taken as reads
+    counts.eliminate_zeros()
+    return counts, index, columns
+
+def _pseudocount(pseudocount, sparse_counts):
+    """
+        Returns the pseudocount to add, by default 1 unless the read counts are a scipy sparse matrix,
+        which would become dense if a pseudocount was added
+    """
+    if pseudocount is None:
+        return 0 if sparse_counts is not None and sparse_counts[1] is None else 1
+    if pseudocount and sparse_counts is not None and sparse_counts[1] is None:
+        raise ValueError("A pseudocount can not be added to a scipy sparse matrix without making it dense, "
+                         "add it when the normalized values are used")
+    return pseudocount
+
+def _scale_sparse(sparse_counts, col_scale, row_scale=None, pseudocount=0):
+    """
+        Multiplies the sparse read counts by the column (and row) scale factors as diagonal matrices
+        Returns a scipy csc matrix if the read counts were one, otherwise a dataframe of sparse columns
+        with the pseudocount as the fill value, so it is only added to the genes with reads
+    """
+    counts, index, columns = sparse_counts
+    scaled = counts.dot(sparse.diags(col_scale))
+    if row_scale is not None:
+        scaled = sparse.diags(row_scale).dot(scaled)
+    scaled = sparse.csc_matrix(scaled)
+    if index is None:
+        return scaled
+    frame = pd.DataFrame.sparse.from_spmatrix(scaled, index, columns)
+    # the columns are rebuilt from their stored values and positions, without making them dense, to add the
+    # pseudocount to the stored values and make it the fill value (from_spmatrix's is NaN in newer pandas)
+    sparse_columns = [pd.arrays.SparseArray(frame.iloc[:, col].array.sp_values + pseudocount,
+                                            sparse_index=frame.iloc[:, col].array.sp_index,
+                                            fill_value=float(pseudocount))
+                      for col in range(scaled.shape[1])]
+    return pd.DataFrame(dict(enumerate(sparse_columns)), index=index).set_axis(columns, axis=1)
+
+def _scale_dense(counts, col_div, row_div=None, pseudocount=0, out=None, dtype=None):
+    """
+        Divides the numpy array of read counts by the column (and row) divisors and adds the pseudocount
+        in place in out, so no copies of the matrix are made besides out
+        out is a caller provided float32 or float64 array of the same shape, which may be counts itself,
+        otherwise a new array of dtype (default float64) is made
+    """
+    if out is None:
+        out = np.empty(counts.shape, dtype=float if dtype is None else dtype)
+    elif out.shape != counts.shape:
+        raise ValueError("out has shape {}, the read counts have shape {}".format(out.shape, counts.shape))
+    np.divide(counts, col_div, out=out)
+    if row_div is not None:
+        np.divide(out, np.asarray(row_div, dtype=float)[:, np.newaxis], out=out)
+    if pseudocount:
+        np.add(out, pseudocount, out=out)
+    return out
+
+def _check_dense_out(sparse_counts, out):
+    """
+        Raises a ValueError if an out array is given for sparse read counts
+    """
+    if sparse_counts is not None and out is not None:
+        raise ValueError("out can only be used with dense read counts")
+
+def _med_log_ratios(counts):
+    """
+        Returns the log ratio of the read number to the geometric mean across samples for each gene
+        in the numpy array without 0 reads in any sample
+    """
+    with np.errstate(divide="ignore"):
+        log_counts = np.log(counts)
+    # Calculates the log geometric mean of the read number across samples
+    log_geo_means = log_counts.mean(axis=1)
+    keep = np.isfinite(log_geo_means)
+    return log_counts[keep] - log_geo_means[keep, np.newaxis]
+
+def _med_log_factors(counts):
+    """
+        Returns the median of the log ratio of read number to geometric mean of each column of the numpy array,
+        going one column at a time so no copy of the matrix is made
+    """
+    with np.errstate(divide="ignore"):
+        # Calculates the log geometric mean of the read number across samples
+        log_geo_means = np.log(counts[:, 0].astype(float))
+        for col in range(1, counts.shape[1]):
+            log_geo_means += np.log(counts[:, col].astype(float))
+    log_geo_means /= counts.shape[1]
+    keep = np.isfinite(log_geo_means)
+    log_geo_means = log_geo_means[keep]
+    return np.array([np.median(np.log(counts[keep, col].astype(float)) - log_geo_means)
+                     for col in range(counts.shape[1])])
+
+def med_size_factors(df):
+    """
+        Calculates the median of ratios size factor of each sample in log space, as in DESeq.
+        Genes with 0 reads in any sample have a geometric mean of 0 and are left out
+        Takes a dataframe, a dataframe of sparse columns or a scipy sparse matrix
+    """
+    sparse_counts = _sparse_counts(df)
+    if sparse_counts is None:
+        counts, columns = df.values, df.columns
+    else:
+        # only genes with reads in every sample are used, so only those rows are made dense
+        csr, columns = sparse_counts[0].tocsr(), sparse_counts[2]
+        counts = csr[np.diff(csr.indptr) == csr.shape[1]].toarray()
+    # Gets the median of the log ratio of read number to geometric mean for each sample
+    return pd.Series(np.exp(_med_log_factors(counts)), index=columns)
+
+def med_norm(df, return_factors=False, pseudocount=None, out=None, dtype=None):
     """
         Median normalizes the read counts in the passed in pandas dataframe
+        A dataframe of sparse columns or scipy sparse matrix stays sparse
+
+        return_factors [optional]: also returns the series of size factors
+        pseudocount [optional]: added to the normalized read counts, defaults to 1, or 0 for scipy sparse matrices
+        out [optional]: float32 or float64 numpy array to write the normalized read counts into, returned as
+                        the values of the dataframe
+        dtype [optional]: data type of the normalized read counts if out is not given, defaults to float64
     """
-    # Calculates the geometric mean of the sgRNA read number across samples
-    sgRNADF = df.apply(stats.mstats.gmean, axis=1)
-    # Divides the read number by the geometric mean
-    divDF = df.div(sgRNADF, axis=0)
-    # Gets the median of this ratio for each sample
-    medSer = divDF.median(axis=0)
-    # Corrects each read number by the median ratio of the sample
-    outDF = df.div(medSer, axis=1)
-    # Adds one to each number
-    outDF = outDF.applymap(lambda x: x+1)
+    size_factors = med_size_factors(df)
+    sparse_counts = _sparse_counts(df)
+    _check_dense_out(sparse_counts, out)
+    pseudocount = _pseudocount(pseudocount, sparse_counts)
+    if sparse_counts is None:
+        # Corrects each read number by the median ratio of the sample and adds the pseudocount
+        out = _scale_dense(df.values, size_factors.values, pseudocount=pseudocount, out=out, dtype=dtype)
+        outDF = pd.DataFrame(out, index=df.index, columns=df.columns, copy=False)
+    else:
+        outDF = _scale_sparse(sparse_counts, 1.0/size_factors.values, pseudocount=pseudocount)
+    if return_factors:
+        return outDF, size_factors
     return outDF
 
-def rpm_norm_df(df):
+def rpm_norm_df(df, pseudocount=None, out=None, dtype=None):
     """
         Reads per million normalizes the passed in pandas dataframe
+        A dataframe of sparse columns or scipy sparse matrix stays sparse
+
+        pseudocount [optional]: added to the normalized read counts, defaults to 1, or 0 for scipy sparse matrices
+        out [optional]: float32 or float64 numpy array to write the normalized read counts into
+        dtype [optional]: data type of the normalized read counts if out is not given, defaults to float64
     """
-    # Calculates the number of reads in each sample
-    readTotalDF = df.sum(axis=0)
-    # Divides the read number by the total number of reads in the sample
-    divDF = df.div(readTotalDF, axis=1)
-    # Multiplies each cell by 1000000 and adds 1
-    outDF = divDF.applymap(lambda x: x*1000000+1)
-    return outDF
+    sparse_counts = _sparse_counts(df)
+    _check_dense_out(sparse_counts, out)
+    pseudocount = _pseudocount(pseudocount, sparse_counts)
+    if sparse_counts is not None:
+        readTotals = np.asarray(sparse_counts[0].sum(axis=0)).ravel()
+        return _scale_sparse(sparse_counts, 1000000.0/readTotals, pseudocount=pseudocount)
+    counts = df.values
+    # Divides the read number by the total number of reads in the sample per million and adds the pseudocount
+    out = _scale_dense(counts, counts.sum(axis=0)/1000000.0, pseudocount=pseudocount, out=out, dtype=dtype)
+    return pd.DataFrame(out, index=df.index, columns=df.columns, copy=False)
 
-def rpm_norm_ser(ser):
+def rpm_norm_ser(ser, pseudocount=1, out=None, dtype=None):
     """
         Reads per million normalizes the passed in pandas series
+        A sparse series stays sparse, with the pseudocount as the fill value
+
+        pseudocount [optional]: added to the normalized read counts, defaults to 1
+        out [optional]: float32 or float64 numpy array to write the normalized read counts into
+        dtype [optional]: data type of the normalized read counts if out is not given, defaults to float64
     """
     # Calculates the total number of reads 
     readTotal = ser.sum()
-    # Divides the read number by the total number of reads in the sample
-    divSer = ser.div(readTotal)
-    # Multiplies each cell by 1000000 and adds 1
-    outSer = divSer.apply(lambda x: x*1000000+1)
-    return outSer
+    if isinstance(ser.dtype, pd.SparseDtype):
+        if out is not None:
+            raise ValueError("out can only be used with dense read counts")
+        # arithmetic on the sparse array is done on the stored values and the fill value
+        return pd.Series(ser.array*(1000000.0/readTotal) + pseudocount, index=ser.index, name=ser.name)
+    # Divides the read number by the total number of reads per million and adds the pseudocount
+    out = _scale_dense(ser.values, readTotal/1000000.0, pseudocount=pseudocount, out=out, dtype=dtype)
+    return pd.Series(out, index=ser.index, name=ser.name, copy=False)
+
+def _gene_len_series(gene_len, index=None, effective=False):
+    """
+        Returns the series of gene lengths in the order of index (if given) from a series, a csv file
+        of gene lengths or a GeneAnnotation
+    """
+    if isinstance(gene_len, GeneAnnotation):
+        return gene_len.gene_len(index, effective)
+    if effective:
+        raise ValueError("Effective lengths need a GeneAnnotation with effective lengths")
+    if not isinstance(gene_len, pd.Series):
+        # get gene lengths from file into series
+        gene_len = pd.read_csv(gene_len, header=None, index_col=0).iloc[:, 0]
+    return gene_len if index is None else gene_len.reindex(index)
+
+LENGTH_METHODS = ("rpkm", "fpkm", "tpm")
+
+def _per_kb(gene_len):
+    """
+        Returns 1000 over the gene lengths, 0 for genes without a length so they do not add to sample sums
+    """
+    with np.errstate(divide="ignore"):
+        per_kb = 1000.0/np.asarray(gene_len, dtype=float)
+    return np.where(np.isfinite(per_kb), per_kb, 0.0)
 
-def rpkm_norm(df, gene_len_file):
+def _length_col_div(counts, gene_len, method):
+    """
+        Returns the divisor of each sample: a million reads for rpkm and fpkm, or a million reads per kilobase
+        for tpm, which is the read counts times 1000 over the gene lengths, so the matrix of rates is never made
+        Takes a numpy array or scipy sparse matrix of read counts
+    """
+    if method == "tpm":
+        col_sums = counts.T.dot(_per_kb(gene_len))
+    else:
+        col_sums = counts.sum(axis=0)
+    return np.asarray(col_sums, dtype=float).ravel()/1000000.0
+
+def length_norm(df, gene_len, method="tpm", effective=False, out=None, dtype=None):
+    """
+        Normalizes the read counts by the number of reads in the sample and the length of the gene in one pass
+        "rpkm" and "fpkm" divide by the million reads (or fragments) in the sample and the kilobases of the gene,
+        "tpm" divides the reads per kilobase of each gene by the million reads per kilobase in the sample
+        A dataframe of sparse columns or scipy sparse matrix stays sparse, the rows of a scipy sparse matrix
+        are taken to be in the order of the genes in gene_len
+
+        gene_len: csv file or series of gene lengths from get_gene_len_gtf, or GeneAnnotation from load_gene_annotation
+        method [optional]: "rpkm", "fpkm" or "tpm"
+        effective [optional]: uses the effective lengths of the GeneAnnotation
+        out [optional]: float32 or float64 numpy array to write the normalized read counts into
+        dtype [optional]: data type of the normalized read counts if out is not given, defaults to float64
+    """
+    if method not in LENGTH_METHODS:
+        raise ValueError("method must be one of {}, not '{}'".format(", ".join(LENGTH_METHODS), method))
+    sparse_counts = _sparse_counts(df)
+    _check_dense_out(sparse_counts, out)
+    # the rows of a scipy sparse matrix have no names
+    index = df.index if sparse_counts is None else sparse_counts[1]
+    gene_len = _gene_len_series(gene_len, index, effective).values.astype(float)
+    if sparse_counts is not None:
+        col_div = _length_col_div(sparse_counts[0], gene_len, method)
+        return _scale_sparse(sparse_counts, 1.0/col_div, 1000.0/gene_len)
+
+    counts = df.values
+    # per million and gene length per kilobase scaling
+    out = _scale_dense(counts, _length_col_div(counts, gene_len, method), gene_len/1000.0, out=out, dtype=dtype)
+    return pd.DataFrame(out, index=df.index, columns=df.columns, copy=False)
+
+def rpkm_norm(df, gene_len_file, out=None, dtype=None):
     """
         Normalizes the mRNA read count by the number of reads in sample
         and by the length of the gene (sum of the exons minus overlap)
+        gene_len_file is a csv file of gene lengths or a GeneAnnotation from load_gene_annotation,
+        which skips reading any file
+        A dataframe of sparse columns or scipy sparse matrix stays sparse, the rows of a scipy sparse matrix
+        are taken to be in the order of the genes in gene_len_file
+
+        out [optional]: float32 or float64 numpy array to write the normalized read counts into
+        dtype [optional]: data type of the normalized read counts if out is not given, defaults to float64
     """
-    # per million scaling
-    samp_sum = df.sum()
-    df_rpm = df.div(samp_sum)
-    df_rpm = df_rpm.applymap(lambda x: x*10**6)
+    return length_norm(df, gene_len_file, "rpkm", out=out, dtype=dtype)
 
-    # get gene lengths from file into series
-    gene_len = pd.read_csv(gene_len_file, header=None, index_col=0, squeeze=True)
+def get_gene_len_gtf(gtf_file, out_file=None, key="gene_name", feature="exon"):
+    """
+        Adds together the exon lengths minus any overlap
+        Takes a gtf file (can be gzipped) as input, which is streamed in blocks and parsed with numpy
+        Exons without the key attribute are skipped, exons on different chromosomes are never merged
 
-    # gene length scaling
-    df_rpbm = df_rpm.div(gene_len, axis="index")
-    df_rpkm = df_rpbm.applymap(lambda x: x*1000)
-    return df_rpkm
+        out_file [optional]: csv file to output the lengths to, without a header as rpkm_norm reads it
+        key [optional]: attribute to add the exons up by, "gene_name", "gene_id" or "transcript_id"
+        feature [optional]: feature type of the lines to add up
 
-def get_gene_len_gtf(gtf_file, out_file):
+        Returns the series of lengths, named GeneLength
     """
-        Adds together the exon lengths minus any overlap
-        Takes a gtf file as input
-    """
-    with open(gtf_file, "r") as fin:
-        gene_name_re = re.compile('; gene_name "(.*?)";')
-        gene_exons = {}
-        for line in fin:
-            if line[0] == "#":
-                continue
-            ele = line.split("\t")
-            if ele[2] != "exon":
-                continue
-            gene_name = gene_name_re.search(ele[8]).group(1)
-            start = int(ele[3])
-            end = int(ele[4])
-            if gene_name in gene_exons:
-                gene_exons[gene_name] += [(start, end)]
-            else:
-                gene_exons[gene_name] = [(start, end)]
-
-    gene_len = pd.Series(name="GeneLength")
-    for gene in gene_exons:
-        exons = sorted(gene_exons[gene])
-        old_end = 0
-        length = 0
-        for start, end in exons:
-            if old_end > start and end > old_end:
-                length += end - old_end
-                old_end = end
-            elif old_end > start and old_end >= end:
-                continue
-            else:
-                length += end - start
-                old_end = end
-        gene_len[gene] = length
-    gene_len.to_csv(out_file)
-
-def tmm_norm(df, ref_samp, trim_fc_perc=30, trim_abs_perc=5):
+    keys, seqnames, starts, ends = [], [], [], []
+    for chunk in read_gtf_chunks(gtf_file, feature, (key,)):
+        has_key = chunk[key] != b""
+        keys += [chunk[key][has_key]]
+        seqnames += [chunk["seqname"][has_key]]
+        starts += [chunk["start"][has_key]]
+        ends += [chunk["end"][has_key]]
+    if keys:
+        genes, lengths = union_lengths(np.concatenate(keys), np.concatenate(starts), np.concatenate(ends),
+                                       np.concatenate(seqnames))
+    else:
+        genes, lengths = np.zeros(0, dtype="S1"), np.zeros(0, dtype=np.int64)
+    gene_len = pd.Series(lengths, index=[gene.decode() for gene in genes], name="GeneLength")
+    if out_file is not None:
+        gene_len.to_csv(out_file, header=False)
+    return gene_len
+
+def effective_lengths(lengths, frag_len):
+    """
+        Corrects the lengths for the fragment length, the number of positions a fragment can start at
+        frag_len is the mean fragment length, or an array of the probability of each fragment length (index),
+        in which case the mean of the fragment lengths which fit in each gene is used
+        Genes shorter than the fragments keep their length
+    """
+    lengths = np.asarray(lengths, dtype=float)
+    if np.ndim(frag_len) == 0:
+        eff_len = lengths - frag_len + 1
+    else:
+        frag_dist = np.asarray(frag_len, dtype=float)
+        # cumulative probability and probability weighted length of the fragments up to each length
+        cum_prob = np.cumsum(frag_dist)
+        cum_len = np.cumsum(frag_dist*np.arange(len(frag_dist)))
+        fit = np.clip(lengths, 0, len(frag_dist)-1).astype(np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eff_len = lengths + 1 - cum_len[fit]/cum_prob[fit]
+    return np.where(eff_len >= 1, eff_len, lengths)
+
+class GeneAnnotation(object):
+    """
+        Gene lengths from a gtf file, and optionally effective lengths, kept as numpy arrays so
+        normalizations can reuse them without reading any file
+        Use load_gene_annotation to make one, or GeneAnnotation.load for a saved one
+    """
+    def __init__(self, genes, lengths, eff_lengths=None):
+        self.genes = pd.Index(genes)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.eff_lengths = None if eff_lengths is None else np.asarray(eff_lengths, dtype=float)
+        # the positions of the genes of the last dataframe, which is usually the next one too
+        self._last_index = None
+        self._last_positions = None
+
+    def __len__(self):
+        return len(self.genes)
+
+    def with_effective_lengths(self, frag_len):
+        """
+            Returns a copy of the annotation holding the lengths corrected for the fragment length
+            (see effective_lengths)
+        """
+        return GeneAnnotation(self.genes, self.lengths, effective_lengths(self.lengths, frag_len))
+
+    def gene_len(self, index=None, effective=False):
+        """
+            Returns the series of gene lengths (or effective lengths) in the order of the index,
+            NaN for genes not in the annotation, or of every gene if index is None
+        """
+        lengths = self.lengths if not effective else self.eff_lengths
+        if lengths is None:
+            raise ValueError("The annotation has no effective lengths, use with_effective_lengths")
+        if index is None:
+            return pd.Series(lengths, index=self.genes, name="GeneLength")
+        if self._last_index is None or not self._last_index.equals(index):
+            self._last_index = pd.Index(index)
+            self._last_positions = self.genes.get_indexer(self._last_index)
+        positions = self._last_positions
+        gene_len = np.where(positions >= 0, lengths[positions], np.nan)
+        return pd.Series(gene_len, index=self._last_index, name="GeneLength")
+
+    def save(self, f_name):
+        """
+            Saves the annotation arrays to an uncompressed numpy .npz file
+        """
+        arrays = {"genes": np.array(self.genes.astype(str).tolist()), "lengths": self.lengths}
+        if self.eff_lengths is not None:
+            arrays["eff_lengths"] = self.eff_lengths
+        np.savez(f_name, **arrays)
+
+    @classmethod
+    def load(cls, f_name):
+        """
+            Loads an annotation saved with GeneAnnotation.save
+        """
+        arrays = np.load(f_name)
+        try:
+            eff_lengths = arrays["eff_lengths"] if "eff_lengths" in arrays.files else None
+            return cls(arrays["genes"], arrays["lengths"], eff_lengths)
+        finally:
+            arrays.close()
+
+def load_gene_annotation(gtf_file, key="gene_name", feature="exon", frag_len=None, cache_dir=None):
+    """
+        Loads the gene lengths of the gtf file from the cache, running get_gene_len_gtf and caching
+        them if needed. Cache files are named by the sha1 of the gtf file, key and feature, so a changed
+        annotation is rebuilt. The sha1 is kept with the size and modified time of the gtf file, so the file
+        is only hashed again when those change
+
+        frag_len [optional]: mean fragment length or fragment length distribution to also hold
+                             effective lengths (see effective_lengths)
+
+        Returns a GeneAnnotation, which rpkm_norm and length_norm take in place of a gene length file
+    """
+    cache_file = os.path.join(get_cache_dir(cache_dir),
+                              "gene_len_{}_{}_{}.npz".format(cached_file_digest(gtf_file, cache_dir), key, feature))
+    if os.path.exists(cache_file):
+        annotation = GeneAnnotation.load(cache_file)
+    else:
+        gene_len = get_gene_len_gtf(gtf_file, key=key, feature=feature)
+        annotation = GeneAnnotation(gene_len.index, gene_len.values)
+        # write to a temporary file first so other jobs never load a partial cache
+        tmp_file = "{}.{}.tmp.npz".format(cache_file[:-len(".npz")], os.getpid())
+        annotation.save(tmp_file)
+        replace_file(tmp_file, cache_file)
+    if frag_len is not None:
+        annotation = annotation.with_effective_lengths(frag_len)
+    return annotation
+
+def _tmm_factors(counts, ref, lib_size, ref_size, trim_fc_perc=30, trim_abs_perc=5):
+    """
+        Calculates the unscaled TMM factor of every column of the numpy array of read counts
+        against the reference read counts, as EdgeR's .calcFactorTMM does for one sample at a time
+        lib_size is the number of reads in each column and ref_size in the reference
+    """
+    ref = ref[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # calculate gene-wise log fold change (logR in EdgeR) and absolute expression (absE in EdgeR)
+        # the same way as EdgeR, so ratios which tie in EdgeR also tie here
+        mg = np.log2((counts/lib_size)/(ref/ref_size))
+        ag = (np.log2(counts/lib_size) + np.log2(ref/ref_size))/2.0
+        # approximate asymptotic variance (v in EdgeR)
+        wrk = (lib_size - counts)/lib_size/counts + (ref_size - ref)/ref_size/ref
+
+    # only genes with reads in both samples are used
+    finite = np.isfinite(mg) & np.isfinite(ag)
+    mg[~finite] = np.nan
+    ag[~finite] = np.nan
+    n_genes = finite.sum(axis=0)
+
+    # rank within each sample, on ties average of rank, used by R
+    mg_ranks = pd.DataFrame(mg).rank(axis=0).values
+    ag_ranks = pd.DataFrame(ag).rank(axis=0).values
+    lo_mg = np.floor(n_genes*(trim_fc_perc/100.0)) + 1
+    lo_ag = np.floor(n_genes*(trim_abs_perc/100.0)) + 1
+    keep = ((mg_ranks >= lo_mg) & (mg_ranks <= n_genes + 1 - lo_mg) &
+            (ag_ranks >= lo_ag) & (ag_ranks <= n_genes + 1 - lo_ag))
+
+    # precision weighted mean of the kept log fold changes
+    with np.errstate(divide="ignore", invalid="ignore"):
+        de_calc = np.where(keep, mg/wrk, 0).sum(axis=0) / np.where(keep, 1.0/wrk, 0).sum(axis=0)
+    de_calc[np.isnan(de_calc)] = 0
+    # samples identical to the reference get a factor of one
+    same = np.nanmax(np.where(finite, np.abs(mg), 0), axis=0) < 1e-6
+    de_calc[same] = 0
+    return 2**de_calc
+
+def _tmm_ref_col(upper_quart, sqrt_sums, lib_size):
+    """
+        Picks the sample whose upper quartile fraction of reads is closest to the mean, as in EdgeR,
+        or the sample with the largest sum of square root read counts if most upper quartiles are 0
+    """
+    upper_quart = upper_quart/lib_size
+    if np.median(upper_quart) < 1e-20:
+        return int(np.argmax(sqrt_sums))
+    return int(np.argmin(np.abs(upper_quart - upper_quart.mean())))
+
+def _sparse_percentile(values, n, q):
+    """
+        Calculates the percentile of a column of n read counts from only its non-zero read counts,
+        interpolating like numpy.percentile
+    """
+    values = np.sort(values)
+    n_zero = n - len(values)
+    pos = q/100.0*(n-1)
+    lo = int(np.floor(pos))
+    ends = [values[i-n_zero] if i >= n_zero else 0.0 for i in (lo, min(lo+1, n-1))]
+    return ends[0] + (ends[1]-ends[0])*(pos-lo)
+
+def _tmm_sparse_factors(counts, ref_samp, columns, trim_fc_perc=30, trim_abs_perc=5):
+    """
+        Calculates the unscaled TMM factor of every column of the scipy sparse csc matrix of read counts
+        Only the genes with reads in both the sample and the reference are made dense, which are the only
+        genes EdgeR uses
+    """
+    lib_size = np.asarray(counts.sum(axis=0)).ravel()
+    if ref_samp is None:
+        # genes with no reads in any sample are left out of the upper quartiles
+        n_genes = (np.diff(counts.tocsr().indptr) > 0).sum()
+        upper_quart = np.array([_sparse_percentile(counts.data[counts.indptr[col]:counts.indptr[col+1]],
+                                                   n_genes, 75)
+                                for col in range(counts.shape[1])])
+        ref_col = _tmm_ref_col(upper_quart, np.asarray(counts.sqrt().sum(axis=0)).ravel(), lib_size)
+    else:
+        # the columns of a scipy sparse matrix are only numbered
+        ref_col = ref_samp if columns is None else columns.get_loc(ref_samp)
+
+    ref_slice = slice(counts.indptr[ref_col], counts.indptr[ref_col+1])
+    factors = np.ones(counts.shape[1])
+    for col in range(counts.shape[1]):
+        samp_slice = slice(counts.indptr[col], counts.indptr[col+1])
+        # genes with reads in both the sample and the reference
+        _, samp_i, ref_i = np.intersect1d(counts.indices[samp_slice], counts.indices[ref_slice],
+                                          assume_unique=True, return_indices=True)
+        factors[col] = _tmm_factors(counts.data[samp_slice][samp_i][:, np.newaxis], counts.data[ref_slice][ref_i],
+                                    lib_size[[col]], lib_size[ref_col], trim_fc_perc, trim_abs_perc)[0]
+    return factors
+
+def _tmm_dense_factors(counts, ref_samp, columns, trim_fc_perc=30, trim_abs_perc=5):
+    """
+        Calculates the unscaled TMM factor of every column of the numpy array of read counts against the reference,
+        one sample at a time as EdgeR does, so only the genes with reads in both columns are copied
+    """
+    lib_size = counts.sum(axis=0).astype(float)
+    if ref_samp is None:
+        # genes with no reads in any sample are left out of the upper quartiles
+        any_reads = np.zeros(counts.shape[0], dtype=bool)
+        for col in range(counts.shape[1]):
+            any_reads |= counts[:, col] > 0
+        upper_quart = np.array([np.percentile(counts[any_reads, col].astype(float), 75)
+                                for col in range(counts.shape[1])])
+        sqrt_sums = np.array([np.sqrt(counts[:, col].astype(float)).sum() for col in range(counts.shape[1])])
+        ref_col = _tmm_ref_col(upper_quart, sqrt_sums, lib_size)
+    else:
+        ref_col = columns.get_loc(ref_samp)
+
+    ref_reads = counts[:, ref_col] > 0
+    factors = np.ones(counts.shape[1])
+    for col in range(counts.shape[1]):
+        # genes with reads in both the sample and the reference
+        both = (counts[:, col] > 0) & ref_reads
+        factors[col] = _tmm_factors(counts[both, col].astype(float)[:, np.newaxis],
+                                    counts[both, ref_col].astype(float), lib_size[[col]], lib_size[ref_col],
+                                    trim_fc_perc, trim_abs_perc)[0]
+    return factors
+
+def tmm_norm_factors(df, ref_samp=None, trim_fc_perc=30, trim_abs_perc=5):
+    """
+        Calculates the trimmed mean of M-values normalization factor of each sample, scaled to multiply to one
+        Python implimentation of EdgeR calcNormFactors(method="TMM")
+        Takes a dataframe, a dataframe of sparse columns or a scipy sparse matrix
+
+        ref_samp [optional]: reference sample column name, defaults to the sample whose upper quartile
+                             is closest to the mean upper quartile, as in EdgeR
+    """
+    sparse_counts = _sparse_counts(df)
+    if sparse_counts is not None:
+        counts, _, columns = sparse_counts
+        factors = _tmm_sparse_factors(counts, ref_samp, columns, trim_fc_perc, trim_abs_perc)
+        return pd.Series(factors/np.exp(np.mean(np.log(factors))), index=columns)
+
+    factors = _tmm_dense_factors(df.values, ref_samp, df.columns, trim_fc_perc, trim_abs_perc)
+    # to make factors multiply to one, divide by geometric mean
+    return pd.Series(factors/np.exp(np.mean(np.log(factors))), index=df.columns)
+
+def tmm_norm(df, ref_samp=None, trim_fc_perc=30, trim_abs_perc=5, return_factors=False, out=None, dtype=None):
     """
         Trimmed mean of M-values normalizes the dataframe to the reference sample
         Python implimentation of EdgeR .calcFactorWeighted
+        A dataframe of sparse columns or scipy sparse matrix stays sparse
+
+        return_factors [optional]: also returns the series of normalization factors
+        out [optional]: float32 or float64 numpy array to write the normalized read counts into
+        dtype [optional]: data type of the normalized read counts if out is not given, defaults to float64
     """
-    samps = df.columns.tolist()
-    fact_ser = pd.Series(index=samps) # series with factors
-
-    # remove all rows with 0 reads for any sample, this is fine for library estimations 
-    # as they would all have extreme fold change 
-    filt_df = df
-    for samp in samps:
-        filt_df = filt_df[filt_df[samp] != 0]
-        
-    for samp in samps:
-        # number reads in sample
-        nS = filt_df.loc[:,samp].sum()
-        # number reads in ref
-        nR = filt_df.loc[:,ref_samp].sum()
-        
-        # fraction of total reads
-        ygk_nS = filt_df.loc[:,samp].div(nS)
-        ygk_nR = filt_df.loc[:,ref_samp].div(nR)
-        
-        # calculate gene-wise log fold change
-        two_mg = ygk_nS/ygk_nR 
-        mg = two_mg.map(lambda x: math.log(x, 2)) # logR in EdgeR
-        
-        # rank fold changes
-        n_mg = len(mg)
-        ranks = mg.rank() # on ties, average of rank, used by R
-        mg_keep_genes = ranks[(ranks > ((trim_fc_perc/100.0)*n_mg)) & (ranks < (1.0-(trim_fc_perc/100.0))*n_mg+1)].index.tolist()
-
-        # absolute expression
-        two_ag = ygk_nS*ygk_nR
-        ag = two_ag.map(lambda x: 0.5*math.log(x, 2)) # absE in EdgeR
-
-        # rank absolute expression
-        n_ag = len(ag)
-        ranks = ag.rank() # on ties, average of rank, used by R
-        ag_keep_genes = ranks[(ranks > ((trim_abs_perc/100.0)*n_ag)) & (ranks < (1.0-(trim_abs_perc/100.0))*n_ag+1)].index.tolist()
-
-        # genes to keep after both trimming
-        keep_genes = [gene for gene in mg_keep_genes if gene in ag_keep_genes]
-
-        # approximate asymptotic variance
-        wrk_left = filt_df.loc[:, samp].map(lambda x: (nS-x)/float((nS*x)))
-        wrk_right = filt_df.loc[:, ref_samp].map(lambda x: (nR-x)/float((nR*x)))
-        wrk = wrk_left + wrk_right # v in EdgeR
-
-        de_calc_first = mg.loc[keep_genes].div(wrk.loc[keep_genes]).sum()
-        de_calc_sec = wrk.loc[keep_genes].map(lambda x: 1/x).sum()
-        de_calc = 2**(de_calc_first/de_calc_sec)
-        fact_ser[samp] = de_calc
-    # to make factors multiply to one, divide by geometric mean
-    geo_mean = stats.mstats.gmean(fact_ser.values.tolist())
-    fact_ser_scaled = fact_ser.map(lambda x: x/geo_mean)
-    scale_counts = df.sum()*fact_ser_scaled
-    # Divides the read number by the scaled number of reads in the sample
-    div_df = df.div(scale_counts)
-    # Multiplies each cell by 1000000
-    out_df = div_df.apply(lambda x: x*1000000.0)
-    return out_df
\ No newline at end of file
+    factors = tmm_norm_factors(df, ref_samp, trim_fc_perc, trim_abs_perc)
+    sparse_counts = _sparse_counts(df)
+    _check_dense_out(sparse_counts, out)
+    if sparse_counts is not None:
+        scale_counts = np.asarray(sparse_counts[0].sum(axis=0)).ravel()*factors.values
+        out_df = _scale_sparse(sparse_counts, 1000000.0/scale_counts)
+        if return_factors:
+            return out_df, factors
+        return out_df
+    counts = df.values
+    scale_counts = counts.sum(axis=0)*factors.values
+    # Divides the read number by the scaled number of reads in the sample per million
+    out = _scale_dense(counts, scale_counts/1000000.0, out=out, dtype=dtype)
+    out_df = pd.DataFrame(out, index=df.index, columns=df.columns, copy=False)
+    if return_factors:
+        return out_df, factors
+    return out_df
@@ -1,10 +1,42 @@
+import bisect
+import gzip
+import json
+import multiprocessing
+import os
 import random
+import warnings
 import pkg_resources
+import numpy as np
 import pandas as pd
 
 from collections import Counter
+from data_processing.cache import file_digest, get_cache_dir, replace_file
+from data_processing.sam_reader import (FLAG_NOT_PRIMARY, FLAG_REVERSE, FLAG_UNMAPPED, is_bam, is_gzip,
+                                        read_alignment_chunks)
+from data_processing.seq_store import _BASE_CODES, _IS_BASE, KmerIndex, SeqStore
 
-def create_mir_dict():
+def _read_mature_alignments(mirna_file):
+    """
+        Yields the chromosome, strand, mature miRNA ID, alignment start, alignment length
+        and first base of the mature miRNA for each alignment in the mature miRNA sam file
+    """
+    with open(mirna_file, "r") as fin:
+        for line in fin:
+            # skip header line
+            if line[0] == "@":
+                continue
+            ele = line.split("\t")
+            start = int(ele[3])
+            length = len(ele[9])
+            if ele[1] == "16" or ele[1] == "272":
+                strand = "-"
+                start_mir = start+length-1 # first base of the mature miRNA
+            else:
+                strand = "+"
+                start_mir = start
+            yield ele[2], strand, ele[0], start, length, start_mir
+
+def create_mir_dict(mirna_file=None):
     """
         Creates a dictionary of chromosomes which hold a positive strand and negative strand dictionary
         which each hold a dictionary with genomic locations as keys and mature miRNA IDs of the miRNAs 
@@ -12,7 +44,8 @@ def create_mir_dict():
         
         Also creates a dictionary with every matID as keys and 0 as values to intialize counter object
     """
-    mirna_file = pkg_resources.resource_filename("data_processing", "data/MatureMiR_aligned.sam")
+    if mirna_file is None:
+        mirna_file = pkg_resources.resource_filename("data_processing", "data/MatureMiR_aligned.sam")
 
     # Create a dictionary with chromosome keys and +/- strand dictionary values
     chrom_dict ={}
@@ -48,134 +81,791 @@ def create_mir_dict():
             if mirID not in mat_ids:
                 mat_ids[mirID] = 0
     return chrom_dict, mat_ids
-    
-def find_mir_match(f_name, chrom_dict, mat_ids):
+
+class MirIndex:
+    def __init__(self, keys, bounds, starts, ends, order, mir_codes, mir_starts, mir_names):
+        """
+            Interval index of the mature miRNA alignments. Intervals are stored in flat arrays,
+            one sorted block per chromosome and strand
+
+            keys: list of (chromosome, strand), one per block
+            bounds: array with the first interval, last interval + 1 and longest interval of each block
+            starts, ends: half open genomic intervals covered by each mature miRNA alignment
+            order: line of the mature miRNA sam file each interval came from
+            mir_codes: position of the mature miRNA ID of each interval in mir_names
+            mir_starts: first base of the mature miRNA of each interval
+            mir_names: list of mature miRNA IDs
+        """
+        self.block_keys = list(keys)
+        self.bounds = bounds
+        self.starts = starts
+        self.ends = ends
+        self.order = order
+        self.mir_codes = mir_codes
+        self.mir_starts = mir_starts
+        self.mir_names = list(mir_names)
+        # python lists are faster than numpy arrays for single bisect lookups
+        self._starts = starts.tolist()
+        self._ends = ends.tolist()
+        self._order = order.tolist()
+        self._mats = [(self.mir_names[code], mir_start) for code, mir_start in zip(mir_codes.tolist(), mir_starts.tolist())]
+        self.blocks = {}
+        for (chrom, strand), (lo, hi, max_len) in zip(self.block_keys, bounds.tolist()):
+            self.blocks.setdefault(chrom, {})[strand] = (lo, hi, max_len)
+
+    def keys(self):
+        """
+            Returns the chromosomes in the index
+        """
+        return self.blocks.keys()
+
+    def may_overlap(self, chrom, strand, al_starts, al_ends):
+        """
+            Takes arrays of read starts and ends and returns a boolean array which is False
+            for the reads too far from every interval to overlap a mature miRNA
+        """
+        if strand not in self.blocks.get(chrom, {}):
+            return np.zeros(len(al_starts), dtype=bool)
+        lo, hi, max_len = self.blocks[chrom][strand]
+        block_starts = self.starts[lo:hi]
+        return (np.searchsorted(block_starts, al_starts-max_len, side="right") <
+                np.searchsorted(block_starts, al_ends, side="left"))
+
+    def regions(self):
+        """
+            Returns a dictionary of chromosome: list of (start, end) intervals on either strand
+        """
+        regions = {}
+        for (chrom, strand), (lo, hi, max_len) in zip(self.block_keys, self.bounds.tolist()):
+            regions.setdefault(chrom, [])
+            regions[chrom] += list(zip(self._starts[lo:hi], self._ends[lo:hi]))
+        return regions
+
+    def save(self, f_name):
+        """
+            Saves the index arrays to an uncompressed numpy .npz file
+        """
+        np.savez(f_name, chroms=np.array([chrom for chrom, strand in self.block_keys]),
+                 strands=np.array([strand for chrom, strand in self.block_keys]),
+                 bounds=self.bounds, starts=self.starts, ends=self.ends, order=self.order,
+                 mir_codes=self.mir_codes, mir_starts=self.mir_starts, mir_names=np.array(self.mir_names))
+
+    @classmethod
+    def load(cls, f_name):
+        """
+            Loads an index saved with MirIndex.save
+        """
+        arrays = np.load(f_name)
+        try:
+            keys = list(zip(arrays["chroms"].tolist(), arrays["strands"].tolist()))
+            return cls(keys, arrays["bounds"], arrays["starts"], arrays["ends"], arrays["order"],
+                       arrays["mir_codes"], arrays["mir_starts"], arrays["mir_names"].tolist())
+        finally:
+            arrays.close()
+
+    def overlaps(self, chrom, strand, al_start, al_end):
+        """
+            Returns a Counter with (mature miRNA ID, first base) keys and the number of bases from
+            al_start up to (not including) al_end which fall in that mature miRNA's interval as values.
+            Keys are added in the same order as find_mir_match adds them using the dictionary
+            from create_mir_dict, so ties are broken the same way
+        """
+        mat_counts = Counter()
+        if strand not in self.blocks.get(chrom, {}):
+            return mat_counts
+        lo, hi, max_len = self.blocks[chrom][strand]
+        starts = self._starts
+        ends = self._ends
+        # only intervals starting within max_len of the read can overlap it
+        first = bisect.bisect_right(starts, al_start-max_len, lo, hi)
+        last = bisect.bisect_left(starts, al_end, lo, hi)
+        hits = []
+        for i in range(first, last):
+            overlap = min(ends[i], al_end) - max(starts[i], al_start)
+            if overlap > 0:
+                # the dictionary adds each miRNA at its first overlapping base, in sam file order
+                hits += [(max(starts[i], al_start), self._order[i], overlap, i)]
+        for loc, line, overlap, i in sorted(hits):
+            mat_counts[self._mats[i]] += overlap
+        return mat_counts
+
+def create_mir_index(mirna_file=None, flank=5):
     """
-        Takes a file name of sam file, chromosome dictionary,
-        and dictionary with mature miRNA IDs keys and values=0 
+        Creates a MirIndex with a sorted block of genomic intervals for each chromosome and strand.
+        Each interval is a mature miRNA alignment +/- flank bp, which covers the same locations as
+        the dictionary created by create_mir_dict, but with one entry per alignment instead of per base.
+
+        Also creates a dictionary with every matID as keys and 0 as values to intialize counter object
+    """
+    if mirna_file is None:
+        mirna_file = pkg_resources.resource_filename("data_processing", "data/MatureMiR_aligned.sam")
+
+    mat_ids = {}
+    mir_names = []
+    mir_codes = {}
+    intervals = []
+    for line, (chromosome, strand, mirID, start, length, start_mir) in enumerate(_read_mature_alignments(mirna_file)):
+        if mirID not in mir_codes:
+            mir_codes[mirID] = len(mir_names)
+            mir_names += [mirID]
+            mat_ids[mirID] = 0
+        intervals += [(chromosome, strand, start-flank, start+length+flank, line, mir_codes[mirID], start_mir)]
+    intervals.sort()
+
+    keys = []
+    bounds = []
+    for i, interval in enumerate(intervals):
+        if keys == [] or keys[-1] != interval[:2]:
+            keys += [interval[:2]]
+            bounds += [[i, i, 0]]
+        bounds[-1][1] = i+1
+        bounds[-1][2] = max(bounds[-1][2], interval[3]-interval[2])
+
+    columns = list(zip(*intervals)) if intervals else [()]*7
+    mir_index = MirIndex(keys, np.array(bounds, dtype=np.int64).reshape(-1, 3),
+                         np.array(columns[2], dtype=np.int64), np.array(columns[3], dtype=np.int64),
+                         np.array(columns[4], dtype=np.int64), np.array(columns[5], dtype=np.int32),
+                         np.array(columns[6], dtype=np.int64), mir_names)
+    return mir_index, mat_ids
+
+def load_mir_index(mirna_file=None, flank=5, cache_dir=None):
+    """
+        Loads the MirIndex of the mature miRNA sam file from the cache, creating and caching it if needed
+        Cache files are named by the sha1 of the sam file and the flank, so a changed reference is rebuilt
+
+        Also returns the dictionary with every matID as keys and 0 as values to intialize counter object
+    """
+    if mirna_file is None:
+        mirna_file = pkg_resources.resource_filename("data_processing", "data/MatureMiR_aligned.sam")
+
+    cache_file = os.path.join(get_cache_dir(cache_dir),
+                              "mir_index_{}_{}.npz".format(file_digest(mirna_file), flank))
+    if os.path.exists(cache_file):
+        mir_index = MirIndex.load(cache_file)
+        return mir_index, dict((mirID, 0) for mirID in mir_index.mir_names)
+
+    mir_index, mat_ids = create_mir_index(mirna_file, flank)
+    # write to a temporary file first so other jobs never load a partial cache
+    tmp_file = "{}.{}.tmp.npz".format(cache_file[:-len(".npz")], os.getpid())
+    mir_index.save(tmp_file)
+    replace_file(tmp_file, cache_file)
+    return mir_index, mat_ids
+
+def _dict_overlaps(chrom_dict, chrom, strand, al_start, al_end):
+    """
+        Returns a Counter with (mature miRNA ID, first base) keys and the number of bases from
+        al_start up to (not including) al_end which are keys in the create_mir_dict dictionary
+    """
+    pos_mat = chrom_dict[chrom][strand]
+    mats = []
+    for loc in range(al_start, al_end):
+        # Check if the location is a key with a corresponing miRNA value
+        if loc in pos_mat:
+            mats += pos_mat[loc]
+    return Counter(mats)
+
+def _choose_mature(mat_counts, rng=random):
+    """
+        Takes a Counter of overlapping mature miRNAs and returns the one with the greatest overlap
+        If several have the greatest overlap, one is chosen at random using rng
+    """
+    if len(mat_counts) == 1:
+        (mat,) = mat_counts.keys() # the comma tells python its a tuple
+        return mat
+    # Want the mature miRNA with the greatest overlap
+    most_common = mat_counts.most_common()
+    greatest = most_common[0][1] # the largest overlap
+    pos_mats = [most_common[0][0]]
+
+    # loop over mature miRNAs until the count is less than the greatest count
+    for mat_tup, counts in most_common:
+        if counts < greatest:
+            break
+        pos_mats += [mat_tup]
+
+    return rng.choice(pos_mats) # Chose a random mature miRNA to assign the read to
+
+def _sam_chunk_bounds(f_name, chunks):
+    """
+        Splits the file into byte ranges which start at the beginning of a line
+        Returns a list with the start of each chunk and the end of the file
+    """
+    size = os.path.getsize(f_name)
+    if is_gzip(f_name):
+        # gzipped sam and bam files can only be read from the start
+        return [0, None]
+    bounds = [0]
+    with open(f_name, "rb") as f_in:
+        for chunk in range(1, chunks):
+            f_in.seek(max(size*chunk//chunks, bounds[-1]))
+            # move to the start of the next line
+            f_in.readline()
+            bounds += [min(f_in.tell(), size)]
+    bounds += [size]
+    return bounds
+
+def _chunk_random(seed, chunk):
+    """
+        Returns the random number generator used to break ties in the chunk
+    """
+    if seed is None:
+        return random.Random()
+    return random.Random("{}:{}".format(seed, chunk))
+
+def _add_coverage(qc_counter, lows, highs):
+    """
+        Adds one to qc_counter for every position from low to high (inclusive) of each pair
+    """
+    if not lows:
+        return
+    lows = np.array(lows, dtype=np.int64)
+    highs = np.array(highs, dtype=np.int64)
+    offset = lows.min()
+    length = highs.max() - offset + 2
+    # difference array, +1 where a read starts covering and -1 after it stops
+    coverage = np.cumsum(np.bincount(lows-offset, minlength=length) - np.bincount(highs-offset+1, minlength=length))
+    for pos in np.flatnonzero(coverage).tolist():
+        qc_counter[pos+int(offset)] += int(coverage[pos])
+
+def _bam_regions(chrom_dict, f_names):
+    """
+        Returns the regions of the MirIndex for reading indexed bam files, so indexed bam files only decode
+        the parts of the genome with miRNAs, or None if there are no bam files to read
+    """
+    if isinstance(chrom_dict, MirIndex) and any(is_bam(f_name) for f_name in f_names):
+        return chrom_dict.regions()
+    return None
+
+def _count_mir_chunk(f_name, start, end, chrom_dict, rng=random, regions=None):
+    """
+        Counts the reads in the lines of the sam file which start between the start and end byte
+        Returns the read counter and QC counter of the chunk
+
+        regions [optional]: regions of the MirIndex to read from indexed bam files (see _bam_regions)
     """
     chroms = chrom_dict.keys() # fetch the list of chromosomes
-    
-    # Check to make sure the passed in file is a sam file
-    if ".sam" not in f_name:
-        return False, False
-        
-    # Create a counter object with mature miRNA miRBase IDs as keys and with initial value set to 0
-    read_counter = Counter(mat_ids)
+    if isinstance(chrom_dict, MirIndex):
+        find_overlaps = chrom_dict.overlaps
+    else:
+        find_overlaps = lambda *args: _dict_overlaps(chrom_dict, *args)
+
+    read_counter = Counter()
     qc_counter = Counter() # keeps track of the number of reads covering each part of the miRNA
-    with open(f_name, "rb") as f_in:
-        for line in f_in:
-            # skip comment lines
-            if line[0] == "@":
+    for records in read_alignment_chunks(f_name, start, end, regions):
+        # only the primary alignment of mapped reads is counted
+        mapped = (records["flag"] & (FLAG_UNMAPPED | FLAG_NOT_PRIMARY)) == 0
+        reverse = (records["flag"] & FLAG_REVERSE) != 0
+        al_starts = records["pos"]
+        al_ends = al_starts + records["seq_len"] - 1
+        names, name_codes = np.unique(records["rname"], return_inverse=True)
+        names = names.astype(str).tolist()
+
+        # find the reads which could overlap a miRNA without looking at each read
+        candidates = np.zeros(len(mapped), dtype=bool)
+        for code, chrom in enumerate(names):
+            if chrom not in chroms:
                 continue
-            ele = line.split("\t")
-            read_name = ele[0]
-            chrom = ele[2]
-            al_start = int(ele[3])
-            al_seq = ele[9]
-            al_end = al_start + len(al_seq) - 1
-            if ele[1] =="16": # sam flag for reverse strand 
-                al_strand = "-"
-            elif ele[1] == "0": # no flags, forward strand
-                al_strand = "+"
-            elif ele[1] == "4": # sam flag for no alignment
+            on_chrom = mapped & (name_codes == code)
+            for strand, on_strand in (("+", ~reverse), ("-", reverse)):
+                reads = on_chrom & on_strand
+                if isinstance(chrom_dict, MirIndex):
+                    reads[reads] = chrom_dict.may_overlap(chrom, strand, al_starts[reads], al_ends[reads])
+                candidates |= reads
+
+        qc_lows = []
+        qc_highs = []
+        name_codes = name_codes.tolist()
+        reverse = reverse.tolist()
+        al_starts = al_starts.tolist()
+        al_ends = al_ends.tolist()
+        for i in np.flatnonzero(candidates).tolist():
+            al_start = al_starts[i]
+            al_end = al_ends[i]
+            al_strand = "-" if reverse[i] else "+"
+            mat_counts = find_overlaps(names[name_codes[i]], al_strand, al_start, al_end)
+            # Stop if the alignment location does not overlap with any miRNAs
+            if not mat_counts:
                 continue
+
+            matID, start_mir = _choose_mature(mat_counts, rng)
+            read_counter[matID] += 1
+            if al_strand == "+":
+                qc_lows += [al_start-start_mir]
+                qc_highs += [al_end-start_mir]
             else:
-                print "Unknown sam flag '{}'".format(ele[1])
-                continue
+                qc_lows += [start_mir-al_end]
+                qc_highs += [start_mir-al_start]
+        _add_coverage(qc_counter, qc_lows, qc_highs)
 
-            if chrom in chroms:
-                pos_mat = chrom_dict[chrom][al_strand]
-                mats = []
-                for loc in range(al_start, al_end):
-                    # Check if the location is a key with a corresponing miRNA value
-                    if loc in pos_mat:
-                        mats += pos_mat[loc]
-                # Stop if the alignment location does not overlap with any miRNAs
-                if mats == []:
-                    continue
-
-                n = len(set(mats)) # number of mature miRNAs read overlaps
-                if n == 1:
-                    (mat,) = set(mats) # the comma tells python its a tuple
-                else:
-                    # Want the mature miRNA with the greatest overlap
-                    mat_counts = Counter(mats).most_common()
-                    greatest = mat_counts[0][1] # the largest overlap
-                    pos_mats = [mat_counts[0][0]]
-
-                    # loop over mature miRNAs until the count is less than the greatest count
-                    for mat_tup, counts in mat_counts:
-                        if counts < greatest:
-                            break
-                        pos_mats += [mat_tup]
-
-                    mat = random.choice(pos_mats) # Chose a random mature miRNA to assign the read to
-                matID, start = mat
-                read_counter[matID] += 1
-                if al_strand == "+":
-                    for i in range(al_start-start, al_end-start+1):
-                        qc_counter[i] += 1
-                else:
-                    for i in range(start-al_end, start-al_start+1):
-                        qc_counter[i] += 1
-        
-        return read_counter, qc_counter
+    return read_counter, qc_counter
+
+# miRNA dictionary or index shared by the worker processes of find_mir_match
+_worker_chrom_dict = None
+
+def _init_mir_worker(chrom_dict, regions=None):
+    global _worker_chrom_dict
+    _worker_chrom_dict = (chrom_dict, regions)
 
+def _count_mir_chunk_worker(args):
+    f_name, start, end, seed, chunk = args
+    chrom_dict, regions = _worker_chrom_dict
+    return _count_mir_chunk(f_name, start, end, chrom_dict, _chunk_random(seed, chunk), regions)
+
+def find_mir_match(f_name, chrom_dict, mat_ids, processes=1, chunks=None, seed=None):
+    """
+        Takes a file name of sam file, chromosome dictionary or MirIndex,
+        and dictionary with mature miRNA IDs keys and values=0 
+
+        processes [optional]: number of worker processes counting chunks of the file
+        chunks [optional]: number of byte ranges to split the file into, defaults to processes.
+                           Gzipped sam and bam files can only be read from the start, so they are
+                           always counted as one chunk (with a warning if more were asked for)
+        seed [optional]: seed for breaking ties, combined with the chunk number so results
+                         can be reproduced with the same number of chunks
+    """
+    # Check to make sure the passed in file is a sam or bam file, only existing files are opened to check
+    # for bam so a missing file which is not a sam file still returns False, False
+    if ".sam" not in f_name and not (os.path.isfile(f_name) and is_bam(f_name)):
+        return False, False
+
+    if chunks is None:
+        chunks = processes
+    bounds = _sam_chunk_bounds(f_name, chunks)
+    if chunks > 1 and len(bounds) == 2:
+        warnings.warn("{} is gzipped or bam, so it is counted as one chunk in one process".format(f_name))
+    chunks = len(bounds) - 1
+    regions = _bam_regions(chrom_dict, [f_name])
+    chunk_args = [(f_name, bounds[i], bounds[i+1], seed, i) for i in range(chunks)]
+
+    if processes > 1 and chunks > 1:
+        pool = multiprocessing.Pool(min(processes, chunks), initializer=_init_mir_worker,
+                                    initargs=(chrom_dict, regions))
+        try:
+            results = pool.map(_count_mir_chunk_worker, chunk_args)
+        finally:
+            pool.close()
+            pool.join()
+    elif seed is None and chunks == 1:
+        # a single chunk uses the random module so random.seed still works
+        results = [_count_mir_chunk(f_name, bounds[0], bounds[1], chrom_dict, regions=regions)]
+    else:
+        results = [_count_mir_chunk(f_name, bounds[i], bounds[i+1], chrom_dict, _chunk_random(seed, i), regions)
+                   for i in range(chunks)]
+
+    # Create a counter object with mature miRNA miRBase IDs as keys and with initial value set to 0
+    read_counter = Counter(mat_ids)
+    qc_counter = Counter()
+    for chunk_reads, chunk_qc in results:
+        read_counter.update(chunk_reads)
+        qc_counter.update(chunk_qc)
+    return read_counter, qc_counter
+
+
+def count_mirna_batch(sam_files, sample_names, workers=1, mirna_file=None, flank=5, seed=None, cache_dir=None):
+    """
+        Counts the reads which overlap with mature miRNAs for several samples
+        The MirIndex is built once and shared by the worker processes, which each count one sam file
+        Returns a float read count dataframe with sample name columns and mature miRNA rows
+        and a QC dataframe with sample name columns and rows of positions relative to the mature miRNA start,
+        both without columns for an empty list of sam files
 
-def count_sgrna(fnameList, sampleNameList, sgRNANameList):
+        sam_files: list of sam files with aligned reads
+        sample_names: list of sample names, one per file in the same order
+        workers [optional]: number of worker processes
+        mirna_file [optional]: sam file of aligned mature miRNAs used to build the MirIndex
+        flank [optional]: number of bp added on either side of the mature miRNA
+        seed [optional]: seed for breaking ties, combined with the sample name
+        cache_dir [optional]: directory of the MirIndex cache used by load_mir_index
+    """
+    mir_index, mat_ids = load_mir_index(mirna_file, flank, cache_dir)
+    sample_args = [(f_name, 0, None, seed, name) for f_name, name in zip(sam_files, sample_names)]
+    regions = _bam_regions(mir_index, sam_files)
+
+    if workers > 1:
+        # the index is passed to each worker once, when the pool starts
+        pool = multiprocessing.Pool(workers, initializer=_init_mir_worker, initargs=(mir_index, regions))
+        try:
+            results = pool.map(_count_mir_chunk_worker, sample_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_mir_worker(mir_index, regions)
+        results = [_count_mir_chunk_worker(args) for args in sample_args]
+
+    # float read counts, as count_sgrna gives
+    count_df = pd.DataFrame(0.0, index=mir_index.mir_names, columns=list(sample_names))
+    for name, (read_counter, qc_counter) in zip(sample_names, results):
+        count_df[name] = pd.Series(read_counter, dtype=float).reindex(count_df.index).fillna(0)
+    if results:
+        qc_df = pd.concat([pd.Series(qc_counter, dtype=float) for read_counter, qc_counter in results],
+                          axis=1, keys=sample_names).fillna(0).sort_index()
+    else:
+        # no sam files give empty dataframes
+        qc_df = pd.DataFrame(index=pd.Index([], dtype=np.int64), dtype=float)
+    qc_df.index.name = "Position"
+    return count_df, qc_df
+
+def _count_sgrna_file(fname, sgRNAIndex):
+    """
+        Counts the reads in one sam or bam file which align to each sgRNA in the pandas Index
+        Returns an array of read counts in the order of the index, the number of aligned reads
+        and the number of unaligned reads
+    """
+    sgCounts = np.zeros(len(sgRNAIndex), dtype=np.int64)
+    aligned = 0
+    unaligned = 0
+    for records in read_alignment_chunks(fname):
+        # Extra alignments of a read are not counted again
+        primary = (records["flag"] & FLAG_NOT_PRIMARY) == 0
+        # Finds the sgRNA the read aligned to (as sgRNAs were treated like chromosomes when creating index)
+        sgs = records["rname"][primary]
+        isAligned = ((records["flag"][primary] & FLAG_UNMAPPED) == 0) & (sgs != b"*")
+        aligned += int(np.count_nonzero(isAligned))
+        unaligned += int(len(isAligned) - np.count_nonzero(isAligned))
+
+        # Maps each sgRNA name to its position in the library once per chunk, not once per read
+        names, nameCodes = np.unique(sgs[isAligned], return_inverse=True)
+        codes = sgRNAIndex.get_indexer(names.astype(str))[nameCodes]
+        sgCounts += np.bincount(codes[codes >= 0], minlength=len(sgRNAIndex))
+    return sgCounts, aligned, unaligned
+
+# sgRNA library shared by the worker processes of count_sgrna
+_worker_sgrna_index = None
+
+def _init_sgrna_worker(sgRNAIndex):
+    global _worker_sgrna_index
+    _worker_sgrna_index = sgRNAIndex
+
+def _count_sgrna_worker(fname):
+    return _count_sgrna_file(fname, _worker_sgrna_index)
+
+def _sgrna_data_frames(countMatrix, aligned, unaligned, sgRNANameList, sampleNameList, sparse=False):
+    """
+        Builds the read count dataframe (sgRNAs x samples) from the samples x sgRNAs count matrix
+        and the summary dataframe from the number of aligned and unaligned reads of each sample
+    """
+    if sparse:
+        # one sparse column per sample, with zero (not NaN) as the fill value
+        sparseColumns = [pd.arrays.SparseArray(sgCounts.astype(float), fill_value=0.0) for sgCounts in countMatrix]
+        outPutDataFrame = pd.DataFrame(dict(enumerate(sparseColumns)), index=sgRNANameList,
+                                       columns=range(len(sparseColumns)))
+        outPutDataFrame.columns = sampleNameList
+    else:
+        outPutDataFrame = pd.DataFrame(countMatrix.T.astype(float), index=sgRNANameList, columns=sampleNameList)
+
+    alignedSampReads = np.asarray(aligned, dtype=float)
+    totalSampReads = alignedSampReads + np.asarray(unaligned, dtype=float)
+    summaryDataFrame = pd.DataFrame({'Total Reads': totalSampReads,
+                                     'Aligned Reads': alignedSampReads,
+                                     'Percent Aligned Reads': (alignedSampReads/totalSampReads)*100.0},
+                                    index=sampleNameList, columns=['Total Reads', 'Aligned Reads', 'Percent Aligned Reads'])
+    return outPutDataFrame, summaryDataFrame
+
+def count_sgrna(fnameList, sampleNameList, sgRNANameList, processes=1, sparse=False):
     """
         Counts the number of reads which align to each sgRNA for each sample
         Takes a list of .sam file names/locations, a list of sample name and a list of sgRNA names
         Returns a read count dataframe with sample name columns and sgRNA rows 
+
+        processes [optional]: number of worker processes, each counts one file at a time
+        sparse [optional]: returns the read counts as a sparse dataframe
     """
-    # Creates a pandas 2D dataframe with sgRNA names as row names and samples as columns
-    outPutDataFrame = pd.DataFrame(0.0, index=sgRNANameList, columns=sampleNameList)
-    
-    # Creates a second dataframe to hold summary statistics for each sample
-    summaryDataFrame = pd.DataFrame(0.0, index=sampleNameList, columns=['Total Reads', 'Aligned Reads', 'Percent Aligned Reads'])
-    
-    # Loops through the files with the aligned reads for each sample 
-    for i in range(len(fnameList)):
-        fname = fnameList[i]
-        sampname = sampleNameList[i]
-        
-        # Keeps track of the number of unaligned reads
-        unaligned = 0
-        
-        # This makes sure the file closes properly even if there is an error while the program is running
-        with open(fname, 'r') as f:
-            # Counter for each sample
-            sgCount = Counter()
-
-            for line in f:
-                # Ignore header lines
-                if line[0] == '@':
-                    continue
-                
-                # Finds the sgRNA the read aligned to (as sgRNAs were treated like chromosomes when creating index)
-                infoList = line.split('\t') # split into a list based on tabs 
-                sg = infoList[2] # the chromosome is the 3rd element in a .sam row
-                
-                # If the read does not align to an sgRNA, add to count of unaligned reads
-                if sg == '*':
-                    unaligned += 1
-                    continue
-                else:
-                    sgCount[sg] += 1
-                
-            # Convert counter to dataframe
-            # fills in the column for the sample with read counts
-            sgNames = sgCount.keys()
-            for sgRNA in sgNames:
-                outPutDataFrame.set_value(sgRNA, sampname, sgCount[sgRNA])
-            
-            # Add the total reads and the aligned reads for the sample to the summary df
-            alignedSampReads = outPutDataFrame[sampname].sum()
-            totalSampReads = alignedSampReads + unaligned
-            perAligned = (alignedSampReads/float(totalSampReads))*100.0
-            summaryDataFrame.set_value(sampname, 'Total Reads', totalSampReads)
-            summaryDataFrame.set_value(sampname, 'Aligned Reads', alignedSampReads)
-            summaryDataFrame.set_value(sampname, 'Percent Aligned Reads', perAligned)
-    
-    return outPutDataFrame, summaryDataFrame
\ No newline at end of file
+    sgRNAIndex = pd.Index(sgRNANameList)
+
+    # Counts the files with the aligned reads for each sample into a samples x sgRNAs matrix
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_sgrna_worker, initargs=(sgRNAIndex,))
+        try:
+            results = pool.map(_count_sgrna_worker, fnameList)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_count_sgrna_file(fname, sgRNAIndex) for fname in fnameList]
+
+    countMatrix = np.zeros((len(sampleNameList), len(sgRNAIndex)), dtype=np.int64)
+    aligned = []
+    unaligned = []
+    for i, (sgCounts, sampAligned, sampUnaligned) in enumerate(results):
+        countMatrix[i] = sgCounts
+        aligned += [sampAligned]
+        unaligned += [sampUnaligned]
+
+    return _sgrna_data_frames(countMatrix, aligned, unaligned, sgRNANameList, sampleNameList, sparse)
+
+def count_sgrna_incremental(fnameList, sampleNameList, sgRNANameList, storeDir, processes=1, sparse=False):
+    """
+        Counts the reads which align to each sgRNA like count_sgrna, but keeps the counts of each file in storeDir
+        so only new or changed files are counted. Files of a sample name already in the store are added to its counts
+        Returns the read count and summary dataframes of every sample in the store
+
+        storeDir: directory with the counts (counts.npy, one row per file) and manifest (manifest.json) of counted files
+        processes [optional]: number of worker processes, each counts one file at a time
+        sparse [optional]: returns the read counts as a sparse dataframe
+    """
+    countFile = os.path.join(storeDir, "counts.npy")
+    manifestFile = os.path.join(storeDir, "manifest.json")
+    if os.path.exists(manifestFile):
+        with open(manifestFile, "r") as fin:
+            manifest = json.load(fin)
+        if manifest["sgRNAs"] != list(sgRNANameList):
+            raise ValueError("The sgRNA list does not match the one counted in {}".format(storeDir))
+        countMatrix = np.load(countFile)
+    else:
+        if not os.path.isdir(storeDir):
+            os.makedirs(storeDir)
+        manifest = {"sgRNAs": list(sgRNANameList), "files": []}
+        countMatrix = np.zeros((0, len(sgRNANameList)), dtype=np.int64)
+
+    # Finds the files which are new or have changed since they were counted
+    stored = dict((entry["path"], i) for i, entry in enumerate(manifest["files"]))
+    hashes = dict((entry["sha1"], i) for i, entry in enumerate(manifest["files"]))
+    changed = False
+    newFiles = []
+    copyRows = []
+    for fname, sampname in zip(fnameList, sampleNameList):
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+        entry = {"path": path, "sample": sampname, "size": stat.st_size, "mtime": stat.st_mtime}
+        old = manifest["files"][stored[path]] if path in stored else None
+        # the file is only hashed if it is new or its size, modified time or sample changed
+        if old is not None and (old["size"], old["mtime"], old["sample"]) == (entry["size"], entry["mtime"], sampname):
+            continue
+        entry["sha1"] = file_digest(path)
+        changed = True
+        if old is not None and old["sha1"] == entry["sha1"]:
+            # same reads, only the file details or sample name changed
+            entry["aligned"] = old["aligned"]
+            entry["unaligned"] = old["unaligned"]
+            manifest["files"][stored[path]] = entry
+        elif old is None and entry["sha1"] in hashes:
+            # these reads were already counted from another file, so its counts are reused
+            row = hashes[entry["sha1"]]
+            source = manifest["files"][row]
+            entry["aligned"] = source["aligned"]
+            entry["unaligned"] = source["unaligned"]
+            if os.path.exists(source["path"]):
+                # a copy of the file, added to its own sample
+                stored[path] = len(manifest["files"])
+                manifest["files"] += [entry]
+                copyRows += [row]
+            else:
+                # the file was moved or renamed, so its entry moves with it
+                del stored[source["path"]]
+                stored[path] = row
+                manifest["files"][row] = entry
+        else:
+            newFiles += [entry]
+
+    if copyRows:
+        countMatrix = np.vstack([countMatrix, countMatrix[copyRows]])
+    if newFiles:
+        sgRNAIndex = pd.Index(sgRNANameList)
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, initializer=_init_sgrna_worker, initargs=(sgRNAIndex,))
+            try:
+                results = pool.map(_count_sgrna_worker, [entry["path"] for entry in newFiles])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_count_sgrna_file(entry["path"], sgRNAIndex) for entry in newFiles]
+
+        countMatrix = np.vstack([countMatrix, np.zeros((len(newFiles), countMatrix.shape[1]), dtype=np.int64)])
+        for entry, (sgCounts, aligned, unaligned) in zip(newFiles, results):
+            entry["aligned"] = aligned
+            entry["unaligned"] = unaligned
+            if entry["path"] in stored:
+                # a changed file replaces its old counts
+                row = stored[entry["path"]]
+                manifest["files"][row] = entry
+            else:
+                row = len(manifest["files"])
+                stored[entry["path"]] = row
+                manifest["files"] += [entry]
+            countMatrix[row] = sgCounts
+        countMatrix = countMatrix[:len(manifest["files"])]
+    if newFiles or copyRows:
+        # write to temporary files first so an interrupted update does not corrupt the store
+        np.save(countFile + ".tmp.npy", countMatrix)
+        replace_file(countFile + ".tmp.npy", countFile)
+    if changed or not os.path.exists(manifestFile):
+        with open(manifestFile + ".tmp", "w") as fout:
+            json.dump(manifest, fout)
+        replace_file(manifestFile + ".tmp", manifestFile)
+
+    # Adds together the files of each sample
+    sampleNames = []
+    for entry in manifest["files"]:
+        if entry["sample"] not in sampleNames:
+            sampleNames += [entry["sample"]]
+    sampleCodes = np.array([sampleNames.index(entry["sample"]) for entry in manifest["files"]], dtype=np.int64)
+    sampleMatrix = np.zeros((len(sampleNames), countMatrix.shape[1]), dtype=np.int64)
+    np.add.at(sampleMatrix, sampleCodes, countMatrix)
+    aligned = np.bincount(sampleCodes, weights=[entry["aligned"] for entry in manifest["files"]], minlength=len(sampleNames))
+    unaligned = np.bincount(sampleCodes, weights=[entry["unaligned"] for entry in manifest["files"]], minlength=len(sampleNames))
+    return _sgrna_data_frames(sampleMatrix, aligned, unaligned, sgRNANameList, sampleNames, sparse)
+
+def create_sgrna_index(sgRNASeqList, mismatches=1):
+    """
+        Creates a KmerIndex of the sgRNA sequences and, with mismatches=1, every sequence one base away from them
+        Each k-mer hits the number of its sgRNA in the library at position 0, or -1 if it is one base away from
+        two sgRNAs (an exact match always wins over a mismatch), and the mismatches of the index are the number
+        of mismatches (0 or 1) of each k-mer. sgRNAs with bases other than A, C, G and T are left out
+        sgRNAs with the same sequence tie on every k-mer, so none of them get reads, with a warning
+    """
+    if mismatches not in (0, 1):
+        raise ValueError("mismatches must be 0 or 1, not {}".format(mismatches))
+    library = SeqStore.from_seqs(sgRNASeqList)
+    k = int(library.lengths[0]) if len(library) else 0
+    if (library.lengths != k).any():
+        raise ValueError("Every sgRNA sequence must have the same length")
+    kmers, valid = library.window_kmers(0, k)
+    guides = np.flatnonzero(valid)
+    kmers = kmers[valid]
+    uniq_kmers, kmer_counts = np.unique(kmers, return_counts=True)
+    if (kmer_counts > 1).any():
+        duplicated = guides[np.isin(kmers, uniq_kmers[kmer_counts > 1])]
+        warnings.warn("sgRNAs {} of the list have the same sequence as another sgRNA, reads of a shared sequence "
+                      "are not counted for any of them".format(duplicated.tolist()))
+    misses = np.zeros(len(kmers), dtype=np.int64)
+    if mismatches:
+        # xor with 1-3 at each base changes it to each of the other 3 bases
+        shifts = np.uint64(2)*np.arange(k, dtype=np.uint64)
+        changes = (np.arange(1, 4, dtype=np.uint64)[:, np.newaxis] << shifts).ravel()
+        kmers = np.concatenate((kmers, (kmers[:, np.newaxis] ^ changes).ravel()))
+        guides = np.concatenate((guides, np.repeat(guides, len(changes))))
+        misses = np.concatenate((misses, np.ones(len(kmers) - len(misses), dtype=np.int64)))
+
+    # the closest sgRNA of each k-mer, or -1 if more than one are as close. k-mers have at most 64 bits,
+    # so they are sorted together with the mismatches as one 64 bit key for k up to 31
+    if k < 32:
+        order = np.argsort(kmers << np.uint64(1) | misses.astype(np.uint64))
+    else:
+        order = np.lexsort((misses, kmers))
+    kmers, guides, misses = kmers[order], guides[order], misses[order]
+    first = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    keys = kmers[first]
+    has_next = np.concatenate((first[1:], [len(kmers)])) - first > 1
+    tied = np.zeros(len(keys), dtype=bool)
+    tied[has_next] = misses[first[has_next] + 1] == misses[first[has_next]]
+    key_guides = np.where(tied, -1, guides[first])
+    return KmerIndex(k, keys, np.arange(len(keys) + 1), key_guides, np.zeros(len(keys), dtype=np.int64), misses[first])
+
+def _read_fastq_blocks(fname, chunk_size=2**22):
+    """
+        Streams the fastq file (can be gzipped) and yields blocks of about chunk_size bytes of whole 4 line records
+    """
+    fin = gzip.open(fname, "rb") if is_gzip(fname) else open(fname, "rb")
+    try:
+        rest = b""
+        while True:
+            block = fin.read(chunk_size)
+            data = rest + block
+            if not block:
+                if data.strip():
+                    yield data if data.endswith(b"\n") else data + b"\n"
+                break
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+            n_records = len(newlines)//4
+            if n_records:
+                cut = int(newlines[4*n_records - 1]) + 1
+                yield data[:cut]
+                rest = data[cut:]
+            else:
+                rest = data
+    finally:
+        fin.close()
+
+def _fastq_window_kmers(block, offset, k, revComp=False):
+    """
+        Returns the k-mer of the guide window (offset bases into the read) of each read of a block of fastq records,
+        as 2 bit codes in an integer (see SeqStore.window_kmers), and whether the read has the whole window without an N
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == 10)
+    newlines = newlines[:len(newlines)//4*4]
+    seqStarts = newlines[0::4] + 1
+    seqEnds = newlines[1::4]
+    # windows files have \r\n line endings
+    seqEnds = seqEnds - (buf[np.maximum(seqEnds - 1, 0)] == 13)
+    first = seqStarts + offset
+    valid = seqEnds - first >= k
+    kmers = np.zeros(len(first), dtype=np.uint64)
+    for i in (range(k-1, -1, -1) if revComp else range(k)):
+        chars = buf[np.minimum(first + i, len(buf) - 1)]
+        codes = _BASE_CODES[chars]
+        if revComp:
+            codes = 3 - codes
+        kmers = kmers << np.uint64(2) | codes.astype(np.uint64)
+        valid &= _IS_BASE[chars]
+    return kmers, valid
+
+def _count_sgrna_fastq_file(fname, sgRNAKmerIndex, offset, revComp=False):
+    """
+        Counts the reads in one fastq file whose guide window matches each sgRNA of the KmerIndex
+        Returns an array of read counts in library order, the number of matched reads and the number of other reads
+    """
+    keyGuides = sgRNAKmerIndex.seq_ids
+    sgCounts = np.zeros(int(keyGuides.max()) + 1 if len(keyGuides) else 0, dtype=np.int64)
+    aligned = 0
+    total = 0
+    for block in _read_fastq_blocks(fname):
+        kmers, valid = _fastq_window_kmers(block, offset, sgRNAKmerIndex.k, revComp)
+        keys = sgRNAKmerIndex.lookup(kmers[valid])
+        guides = keyGuides[keys[keys >= 0]]
+        guides = guides[guides >= 0]
+        sgCounts += np.bincount(guides, minlength=len(sgCounts))
+        aligned += len(guides)
+        total += len(kmers)
+    return sgCounts, aligned, total - aligned
+
+# sgRNA k-mer index and guide window shared by the worker processes of count_sgrna_fastq
+_worker_sgrna_kmers = None
+
+def _init_sgrna_fastq_worker(sgRNAKmerIndex, offset, revComp):
+    global _worker_sgrna_kmers
+    _worker_sgrna_kmers = (sgRNAKmerIndex, offset, revComp)
+
+def _count_sgrna_fastq_worker(fname):
+    return _count_sgrna_fastq_file(fname, *_worker_sgrna_kmers)
+
+def count_sgrna_fastq(fnameList, sampleNameList, sgRNANameList, sgRNASeqList, offset=0, mismatches=1,
+                      revComp=False, processes=1, sparse=False):
+    """
+        Counts the reads of each sample which match each sgRNA without aligning them, as count_sgrna
+        The guide window, offset bases into each read, is looked up in a hash index of the sgRNA sequences
+        and every sequence one mismatch away from them (create_sgrna_index). Windows one mismatch away
+        from two sgRNAs or with an N are not counted
+        Takes a list of fastq file names/locations (can be gzipped), a list of sample names, a list of sgRNA names
+        and a list of sgRNA sequences in the same order
+        Returns a read count dataframe with sample name columns and sgRNA rows and a summary dataframe
+
+        offset [optional]: first base of the guide in the reads
+        mismatches [optional]: 0 for exact matches only or 1 to also count windows with one mismatch
+        revComp [optional]: the reads are the reverse complement of the sgRNA sequences
+        processes [optional]: number of worker processes, each counts one file at a time
+        sparse [optional]: returns the read counts as a sparse dataframe
+    """
+    sgRNAKmerIndex = create_sgrna_index(sgRNASeqList, mismatches)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_sgrna_fastq_worker,
+                                    initargs=(sgRNAKmerIndex, offset, revComp))
+        try:
+            results = pool.map(_count_sgrna_fastq_worker, fnameList)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_count_sgrna_fastq_file(fname, sgRNAKmerIndex, offset, revComp) for fname in fnameList]
+
+    countMatrix = np.zeros((len(sampleNameList), len(sgRNANameList)), dtype=np.int64)
+    aligned = []
+    unaligned = []
+    for i, (sgCounts, sampAligned, sampUnaligned) in enumerate(results):
+        countMatrix[i, :len(sgCounts)] = sgCounts
+        aligned += [sampAligned]
+        unaligned += [sampUnaligned]
+
+    return _sgrna_data_frames(countMatrix, aligned, unaligned, sgRNANameList, sampleNameList, sparse)
@@ -0,0 +1,364 @@
+import gzip
+import os
+import struct
+import zlib
+import numpy as np
+
+# sam flag bits
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_MATE_REVERSE = 0x20
+FLAG_FIRST = 0x40
+FLAG_SECOND = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_QC_FAIL = 0x200
+FLAG_DUPLICATE = 0x400
+FLAG_SUPPLEMENTARY = 0x800
+
+# records which are extra alignments of a read already counted
+FLAG_NOT_PRIMARY = FLAG_SECONDARY | FLAG_SUPPLEMENTARY
+
+def is_gzip(f_name):
+    """
+        Checks the first two bytes of the file for the gzip magic number
+    """
+    with open(f_name, "rb") as fin:
+        return fin.read(2) == b"\x1f\x8b"
+
+def _field_ints(buf, starts, ends):
+    """
+        Parses the unsigned integers between starts and ends in the byte array
+    """
+    values = np.zeros(len(starts), dtype=np.int64)
+    lengths = ends - starts
+    for i in range(int(lengths.max()) if len(lengths) else 0):
+        has_digit = lengths > i
+        digits = buf[np.where(has_digit, starts+i, 0)].astype(np.int64) - 48
+        values = np.where(has_digit, values*10 + digits, values)
+    return values
+
+def _field_strings(buf, starts, ends):
+    """
+        Returns a fixed width bytes array with the fields between starts and ends in the byte array
+    """
+    lengths = ends - starts
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    cols = np.arange(width)
+    chars = buf[np.minimum(starts[:, None] + cols, len(buf)-1)]
+    chars[cols >= lengths[:, None]] = 0
+    return np.ascontiguousarray(chars).view("S{}".format(width)).ravel()
+
+def parse_sam_block(data):
+    """
+        Parses a block of complete sam lines into a dictionary of column arrays:
+        qname, flag, rname, pos and seq_len. Header lines and lines without the 11 mandatory
+        fields are skipped. Each column is parsed for every line at once
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == 10)
+    line_starts = np.concatenate(([0], line_ends[:-1]+1))
+    tabs = np.flatnonzero(buf == 9)
+    first_tab = np.searchsorted(tabs, line_starts)
+    n_tabs = np.searchsorted(tabs, line_ends) - first_tab
+
+    keep = n_tabs >= 10
+    keep[keep] = buf[line_starts[keep]] != ord("@")
+    line_starts = line_starts[keep]
+    first_tab = first_tab[keep]
+
+    def field(k):
+        start = line_starts if k == 0 else tabs[first_tab+k-1]+1
+        return start, tabs[first_tab+k]
+
+    seq_start, seq_end = field(9)
+    return {"qname": _field_strings(buf, *field(0)),
+            "flag": _field_ints(buf, *field(1)),
+            "rname": _field_strings(buf, *field(2)),
+            "pos": _field_ints(buf, *field(3)),
+            "seq_len": seq_end - seq_start}
+
+def read_sam_chunks(f_name, start=0, end=None, chunk_size=2**22):
+    """
+        Streams the sam file and yields dictionaries of column arrays (see parse_sam_block)
+        for about chunk_size bytes of lines at a time. Gzipped sam files are read transparently
+
+        start [optional]: byte offset of the first line to read, must be the start of a line
+        end [optional]: lines starting at or after this byte offset are not read
+    """
+    if is_gzip(f_name):
+        if start != 0 or end is not None:
+            raise ValueError("Byte ranges can not be read from gzipped file {}".format(f_name))
+        fin = gzip.open(f_name, "rb")
+    else:
+        fin = open(f_name, "rb")
+    try:
+        fin.seek(start)
+        pos = start
+        rest = b""
+        while end is None or pos < end:
+            block = fin.read(chunk_size)
+            if not block:
+                if rest:
+                    yield parse_sam_block(rest + b"\n")
+                break
+            block = rest + block
+            last_line = block.rfind(b"\n") + 1
+            if end is not None and pos + last_line >= end:
+                # finish the line which crosses the end of the range
+                last_line = block.find(b"\n", max(end-pos-1, 0)) + 1
+                if last_line == 0:
+                    rest = block
+                    continue
+                pos = end
+            else:
+                pos += last_line
+            rest = block[last_line:]
+            if last_line:
+                yield parse_sam_block(block[:last_line])
+    finally:
+        fin.close()
+
+def is_bam(f_name):
+    """
+        Checks if the file is a bgzf compressed bam file
+    """
+    if not is_gzip(f_name):
+        return False
+    with gzip.open(f_name, "rb") as fin:
+        return fin.read(4) == b"BAM\x01"
+
+def _read_exact(fin, n_bytes):
+    data = fin.read(n_bytes)
+    if len(data) != n_bytes:
+        raise ValueError("Truncated bam file")
+    return data
+
+def _read_bam_header(fin):
+    """
+        Reads the bam header from the decompressed stream and returns the list of reference names
+    """
+    if _read_exact(fin, 4) != b"BAM\x01":
+        raise ValueError("Not a bam file")
+    (l_text,) = struct.unpack("<i", _read_exact(fin, 4))
+    _read_exact(fin, l_text)
+    (n_ref,) = struct.unpack("<i", _read_exact(fin, 4))
+    ref_names = []
+    for i in range(n_ref):
+        (l_name,) = struct.unpack("<i", _read_exact(fin, 4))
+        ref_names += [_read_exact(fin, l_name).rstrip(b"\x00")]
+        _read_exact(fin, 4) # reference length
+    return ref_names
+
+def _field_uints(buf, starts, n_bytes):
+    """
+        Parses the little endian unsigned integers of n_bytes at starts in the byte array
+    """
+    values = np.zeros(len(starts), dtype=np.int64)
+    for i in range(n_bytes):
+        values |= buf[starts+i].astype(np.int64) << (8*i)
+    return values
+
+def _to_signed(values, n_bytes=4):
+    values[values >= 2**(8*n_bytes-1)] -= 2**(8*n_bytes)
+    return values
+
+def parse_bam_block(data, ref_names):
+    """
+        Parses the complete bam records at the start of the decompressed data into the same dictionary
+        of column arrays as parse_sam_block. Returns the dictionary and the number of bytes parsed
+    """
+    # each record starts with its length, so the record offsets have to be found one by one
+    offsets = []
+    pos = 0
+    while pos + 4 <= len(data):
+        (block_size,) = struct.unpack_from("<i", data, pos)
+        if pos + 4 + block_size > len(data):
+            break
+        offsets += [pos]
+        pos += 4 + block_size
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts = np.array(offsets, dtype=np.int64)
+    ref_ids = _to_signed(_field_uints(buf, starts+4, 4))
+    name_len = _field_uints(buf, starts+12, 1)
+    seq_len = _field_uints(buf, starts+20, 4)
+    # '*' in the seq column of a sam file has length 1
+    seq_len[seq_len == 0] = 1
+    # refID -1 (unmapped) picks the '*' at the end
+    names = np.array(list(ref_names) + [b"*"])
+    return {"qname": _field_strings(buf, starts+36, starts+36+name_len-1),
+            "flag": _field_uints(buf, starts+18, 2),
+            "rname": names[ref_ids],
+            "pos": _to_signed(_field_uints(buf, starts+8, 4)) + 1,
+            "seq_len": seq_len}, pos
+
+def _reg2bins(beg, end):
+    """
+        Returns the bam index bins which can hold alignments overlapping the 0 based region beg to end
+    """
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins += list(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+def _read_bai(bai_file):
+    """
+        Reads the bam index into a list with a dictionary of bin: chunk list and the linear index for each reference
+    """
+    with open(bai_file, "rb") as fin:
+        data = fin.read()
+    if data[:4] != b"BAI\x01":
+        raise ValueError("Not a bam index: {}".format(bai_file))
+    (n_ref,) = struct.unpack_from("<i", data, 4)
+    pos = 8
+    index = []
+    for i in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        bins = {}
+        for j in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            chunks = struct.unpack_from("<{}Q".format(2*n_chunk), data, pos)
+            pos += 16*n_chunk
+            bins[bin_id] = list(zip(chunks[::2], chunks[1::2]))
+        (n_intv,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        linear = struct.unpack_from("<{}Q".format(n_intv), data, pos)
+        pos += 8*n_intv
+        index += [(bins, linear)]
+    return index
+
+def _find_bai(f_name):
+    for bai_file in (f_name + ".bai", f_name[:-len(".bam")] + ".bai" if f_name.endswith(".bam") else None):
+        if bai_file is not None and os.path.exists(bai_file):
+            return bai_file
+    return None
+
+def _merge_regions(regions):
+    """
+        Sorts and merges overlapping (start, end) regions
+    """
+    merged = []
+    for start, end in sorted(regions):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged += [[start, end]]
+    return merged
+
+def _region_chunks(bai_index, ref_id, regions):
+    """
+        Returns the merged (begin, end) virtual offsets of the bam file which can hold
+        alignments overlapping the 1 based, half open regions of the reference
+    """
+    bins, linear = bai_index[ref_id]
+    chunks = []
+    for start, end in regions:
+        beg0 = max(start-1, 0)
+        # alignments ending before this virtual offset can not overlap the region
+        min_offset = linear[min(beg0 >> 14, len(linear)-1)] if linear else 0
+        for bin_id in _reg2bins(beg0, max(end-1, beg0+1)):
+            for chunk_beg, chunk_end in bins.get(bin_id, []):
+                if chunk_end > min_offset:
+                    chunks += [(max(chunk_beg, min_offset), chunk_end)]
+    return [tuple(chunk) for chunk in _merge_regions(chunks)]
+
+def _read_bgzf_block(fin, coffset):
+    """
+        Decompresses the bgzf block starting at coffset and returns the data and the offset of the next block
+    """
+    fin.seek(coffset)
+    header = fin.read(12)
+    if len(header) < 12:
+        return b"", coffset
+    (xlen,) = struct.unpack_from("<H", header, 10)
+    extra = fin.read(xlen)
+    block_size = None
+    pos = 0
+    while pos < xlen:
+        si1, si2, slen = struct.unpack_from("<BBH", extra, pos)
+        if si1 == 66 and si2 == 67:
+            (block_size,) = struct.unpack_from("<H", extra, pos+4)
+        pos += 4 + slen
+    if block_size is None:
+        raise ValueError("Not a bgzf block at offset {}".format(coffset))
+    cdata = fin.read(block_size + 1 - 12 - xlen - 8)
+    fin.read(8) # crc and size
+    return zlib.decompress(cdata, -15), coffset + block_size + 1
+
+def _read_bam_chunk(fin, chunk_beg, chunk_end):
+    """
+        Returns the decompressed data between the two virtual offsets
+    """
+    coffset = chunk_beg >> 16
+    data = []
+    while coffset <= chunk_end >> 16:
+        block, next_offset = _read_bgzf_block(fin, coffset)
+        if not block and next_offset == coffset:
+            break
+        if coffset == chunk_end >> 16:
+            block = block[:chunk_end & 0xFFFF]
+        data += [block]
+        coffset = next_offset
+    return b"".join(data)[chunk_beg & 0xFFFF:]
+
+def _to_bytes(name):
+    return name if isinstance(name, bytes) else name.encode()
+
+def read_bam_chunks(f_name, regions=None, chunk_size=2**22):
+    """
+        Streams the bam file and yields the same dictionaries of column arrays as read_sam_chunks
+        The bgzf blocks are decompressed as they are read
+
+        regions [optional]: dictionary of reference name: list of 1 based, half open (start, end) regions.
+                            If the bam file has a .bai index, only the parts of the file which can hold
+                            alignments overlapping the regions are decompressed and only alignments
+                            overlapping the regions are returned. Without an index the whole file is read
+    """
+    with gzip.open(f_name, "rb") as fin:
+        ref_names = _read_bam_header(fin)
+        bai_file = _find_bai(f_name) if regions is not None else None
+        if bai_file is None:
+            rest = b""
+            while True:
+                block = fin.read(chunk_size)
+                if not block:
+                    break
+                records, parsed = parse_bam_block(rest + block, ref_names)
+                rest = (rest + block)[parsed:]
+                yield records
+            return
+
+    bai_index = _read_bai(bai_file)
+    ref_ids = dict((name, i) for i, name in enumerate(ref_names))
+    with open(f_name, "rb") as fin:
+        for ref_name in sorted(regions, key=lambda name: ref_ids.get(_to_bytes(name), -1)):
+            ref_id = ref_ids.get(_to_bytes(ref_name))
+            if ref_id is None or ref_id >= len(bai_index):
+                continue
+            merged = _merge_regions(regions[ref_name])
+            region_starts = np.array([start for start, end in merged])
+            region_ends = np.array([end for start, end in merged])
+            for chunk_beg, chunk_end in _region_chunks(bai_index, ref_id, merged):
+                records, parsed = parse_bam_block(_read_bam_chunk(fin, chunk_beg, chunk_end), ref_names)
+                # keep the alignments on the reference which overlap one of the regions
+                closest = np.searchsorted(region_starts, records["pos"] + records["seq_len"], side="left") - 1
+                keep = ((records["rname"] == ref_names[ref_id]) & (closest >= 0) &
+                        (region_ends[np.maximum(closest, 0)] > records["pos"]))
+                yield dict((column, values[keep]) for column, values in records.items())
+
+def read_alignment_chunks(f_name, start=0, end=None, regions=None, chunk_size=2**22):
+    """
+        Yields dictionaries of column arrays from a sam, gzipped sam or bam file
+        Byte ranges (start and end) are used for sam files and regions for indexed bam files
+    """
+    if is_bam(f_name):
+        if start != 0 or end is not None:
+            raise ValueError("Byte ranges can not be read from bam file {}".format(f_name))
+        return read_bam_chunks(f_name, regions, chunk_size)
+    return read_sam_chunks(f_name, start, end, chunk_size)
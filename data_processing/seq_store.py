@@ -0,0 +1,292 @@
+import numpy as np
+
+# 2 bit code of each base, A=0 C=1 G=2 T/U=3 so the complement of a code is 3 - code,
+# every other character is stored as an N in the mask (with code 0)
+_BASE_CODES = np.zeros(256, dtype=np.uint8)
+for _bases, _code in (("Aa", 0), ("Cc", 1), ("Gg", 2), ("TtUu", 3)):
+    _BASE_CODES[np.frombuffer(_bases.encode(), dtype=np.uint8)] = _code
+_IS_BASE = np.zeros(256, dtype=bool)
+_IS_BASE[np.frombuffer(b"ACGTUacgtu", dtype=np.uint8)] = True
+_DNA_LETTERS = np.frombuffer(b"ACGT", dtype=np.uint8)
+_RNA_LETTERS = np.frombuffer(b"ACGU", dtype=np.uint8)
+
+def _rev_comp_byte(byte):
+    """
+        Returns the byte of 4 packed bases reverse complemented
+    """
+    codes = [(byte >> shift) & 3 for shift in (6, 4, 2, 0)]
+    return sum((3 - code) << shift for code, shift in zip(codes[::-1], (6, 4, 2, 0)))
+
+# reverse complement of each byte of 4 packed bases
+_REV_COMP_BYTES = np.array([_rev_comp_byte(byte) for byte in range(256)], dtype=np.uint8)
+
+# multiplier of the fibonacci hash of the k-mer index
+_HASH_MULT = np.uint64(0x9E3779B97F4A7C15)
+
+def _pack_codes(codes):
+    """
+        Packs an array of 2 bit codes 4 per byte, first base in the highest bits, padding the last byte with 0
+    """
+    codes = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype=np.uint8))).reshape(-1, 4)
+    return (codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]).astype(np.uint8)
+
+class SeqStore:
+    def __init__(self, packed, n_mask, starts, lengths, n_bases, rna=False):
+        """
+            Sequences packed 2 bits per base into one stream of bytes, with a bit mask of the N bases
+            Sequences are (start, length) slices of the stream, so reverse complementing the stream
+            only moves the starts
+
+            packed: uint8 array of the bases of the stream, 4 per byte (see _pack_codes)
+            n_mask: np.packbits of the N bases of the stream
+            starts, lengths: first base and number of bases of each sequence in the stream
+            n_bases: number of bases in the stream
+            rna [optional]: the sequences are RNA, written with U instead of T
+        """
+        self.packed = packed
+        self.n_mask = n_mask
+        self.starts = starts
+        self.lengths = lengths
+        self.n_bases = n_bases
+        self.rna = rna
+
+    @classmethod
+    def from_seqs(cls, seqs, rna=None):
+        """
+            Packs a list of DNA or RNA sequences (strings or bytes). Bases other than A, C, G, T and U are stored
+            as N and lowercase bases as uppercase
+            rna [optional]: the sequences are RNA, otherwise RNA if the first sequence has a U
+        """
+        seqs = list(seqs)
+        joined = b"".join(seqs) if seqs and isinstance(seqs[0], bytes) else "".join(seqs).encode("ascii")
+        chars = np.frombuffer(joined, dtype=np.uint8)
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        if rna is None:
+            first = chars[:lengths[0]] if len(seqs) else chars
+            rna = bool(np.isin(first, np.frombuffer(b"Uu", dtype=np.uint8)).any())
+        return cls(_pack_codes(_BASE_CODES[chars]), np.packbits(~_IS_BASE[chars]), starts, lengths, len(chars), rna)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def nbytes(self):
+        """
+            Bytes taken by the arrays of the store
+        """
+        return self.packed.nbytes + self.n_mask.nbytes + self.starts.nbytes + self.lengths.nbytes
+
+    def codes(self):
+        """
+            Returns the 2 bit code of every base of the stream, one per byte
+        """
+        shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+        return ((self.packed[:, np.newaxis] >> shifts) & 3).ravel()[:self.n_bases]
+
+    def is_n(self):
+        """
+            Returns a boolean array which is True for the N bases of the stream
+        """
+        return np.unpackbits(self.n_mask, count=self.n_bases).astype(bool)
+
+    def _letters(self):
+        """
+            Returns the stream as one string
+        """
+        letters = (_RNA_LETTERS if self.rna else _DNA_LETTERS)[self.codes()]
+        letters[self.is_n()] = ord("N")
+        return letters.tobytes().decode("ascii")
+
+    def to_list(self):
+        """
+            Returns the list of sequences as strings
+        """
+        stream = self._letters()
+        return [stream[start:start+length] for start, length in zip(self.starts.tolist(), self.lengths.tolist())]
+
+    def __getitem__(self, i):
+        start, length = int(self.starts[i]), int(self.lengths[i])
+        bases = np.arange(start, start + length)
+        codes = (self.packed[bases >> 2] >> (6 - 2*(bases & 3)).astype(np.uint8)) & 3
+        letters = (_RNA_LETTERS if self.rna else _DNA_LETTERS)[codes]
+        letters[(self.n_mask[bases >> 3] >> (7 - (bases & 7)).astype(np.uint8)) & 1 == 1] = ord("N")
+        return letters.tobytes().decode("ascii")
+
+    def _with(self, packed=None, n_mask=None, starts=None, rna=None):
+        """
+            Returns a store sharing the arrays which are not given
+        """
+        return SeqStore(self.packed if packed is None else packed, self.n_mask if n_mask is None else n_mask,
+                        self.starts if starts is None else starts, self.lengths, self.n_bases,
+                        self.rna if rna is None else rna)
+
+    def rev_comp(self):
+        """
+            Returns a store of every sequence reverse complemented, in the same order
+            The packed bytes are reversed and complemented through a lookup table, which reverse complements
+            the whole stream, so each sequence starts where its end was counted from the other end
+        """
+        rev = _REV_COMP_BYTES[self.packed[::-1]]
+        pad = -self.n_bases % 4
+        if pad:
+            # the padding at the end of the stream is now at the start, the stream is shifted left over it
+            shift = 2*pad
+            next_bytes = np.concatenate((rev[1:], np.zeros(1, dtype=np.uint8)))
+            rev = ((rev.astype(np.uint16) << shift | next_bytes >> (8 - shift)) & 0xFF).astype(np.uint8)
+        n_mask = np.packbits(np.unpackbits(self.n_mask, count=self.n_bases)[::-1])
+        return self._with(rev, n_mask, self.n_bases - self.starts - self.lengths)
+
+    def transcribe(self):
+        """
+            Transcribes every DNA sequence into RNA, reverse complemented as dna_functions.transcribe
+        """
+        return self.rev_comp()._with(rna=True)
+
+    def rev_trans(self):
+        """
+            Reverse transcribes every RNA sequence into DNA, reverse complemented as dna_functions.rev_trans
+        """
+        return self.rev_comp()._with(rna=False)
+
+    def dna_to_rna(self):
+        """
+            Directly converts every DNA sequence to RNA, which only changes how T is written
+        """
+        return self._with(rna=True)
+
+    def rna_to_dna(self):
+        """
+            Directly converts every RNA sequence to DNA, which only changes how U is written
+        """
+        return self._with(rna=False)
+
+    def window_kmers(self, offset, k):
+        """
+            Returns the k-mer starting offset bases into each sequence as 2 bit codes in an integer,
+            first base in the highest bits, and a boolean array which is False for the sequences which
+            are too short or have an N in the window
+        """
+        if k > 32:
+            raise ValueError("k-mers are packed into 64 bit integers, so k can be at most 32, not {}".format(k))
+        valid = self.lengths >= offset + k
+        kmers = np.zeros(len(self), dtype=np.uint64)
+        first = self.starts + offset
+        for i in range(k):
+            bases = np.minimum(first + i, max(self.n_bases - 1, 0))
+            codes = (self.packed[bases >> 2] >> (6 - 2*(bases & 3)).astype(np.uint8)) & 3
+            kmers = kmers << np.uint64(2) | codes.astype(np.uint64)
+            valid &= ((self.n_mask[bases >> 3] >> (7 - (bases & 7)).astype(np.uint8)) & 1) == 0
+        kmers[~valid] = 0
+        return kmers, valid
+
+    def kmers(self, k):
+        """
+            Returns every k-mer without an N of every sequence as 2 bit codes in an integer,
+            with the sequence and position in the sequence it starts at
+        """
+        if k > 32:
+            raise ValueError("k-mers are packed into 64 bit integers, so k can be at most 32, not {}".format(k))
+        codes = self.codes().astype(np.uint64)
+        n_windows = max(self.n_bases - k + 1, 0)
+        # k-mers starting at every base of the stream
+        stream_kmers = np.zeros(n_windows, dtype=np.uint64)
+        for i in range(k):
+            stream_kmers = stream_kmers << np.uint64(2) | codes[i:i+n_windows]
+        n_before = np.concatenate(([0], np.cumsum(self.is_n())))
+        counts = np.maximum(self.lengths - k + 1, 0)
+        seq_ids = np.repeat(np.arange(len(self)), counts)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        stream_pos = self.starts[seq_ids] + positions
+        no_n = n_before[stream_pos + k] == n_before[stream_pos]
+        return stream_kmers[stream_pos[no_n]], seq_ids[no_n], positions[no_n]
+
+    def kmer_index(self, k):
+        """
+            Returns a KmerIndex of every k-mer without an N of every sequence
+        """
+        return KmerIndex.from_kmers(k, *self.kmers(k))
+
+def _hash_slots(kmers, n_bits):
+    """
+        Fibonacci hash of the k-mers into a table of 2**n_bits slots
+    """
+    return (kmers * _HASH_MULT >> np.uint64(64 - n_bits)).astype(np.int64)
+
+class KmerIndex:
+    def __init__(self, k, keys, hit_starts, seq_ids, positions, mismatches=None):
+        """
+            Hash index of k-mers (2 bit codes in an integer, see SeqStore.kmers) to the sequences they are in
+            The k-mers are kept in an open addressing hash table with linear probing, which is filled and
+            probed for whole arrays of k-mers at a time
+
+            k: length of the k-mers
+            keys: sorted unique k-mers
+            hit_starts: first hit of each k-mer in seq_ids and positions, and the number of hits at the end
+            seq_ids, positions: sequence and position in the sequence of each hit, grouped by k-mer
+            mismatches [optional]: number of mismatches of each hit to its sequence, for an index which also
+                                   holds k-mers near the sequences (see create_sgrna_index)
+        """
+        self.k = k
+        self.keys = keys
+        self.hit_starts = hit_starts
+        self.seq_ids = seq_ids
+        self.positions = positions
+        self.mismatches = mismatches
+        # a table at least twice the number of k-mers keeps the probe sequences short
+        self.n_bits = max(int(np.ceil(np.log2(2*len(keys) + 1))), 1)
+        slots = np.full(1 << self.n_bits, -1, dtype=np.int64)
+        todo = np.arange(len(keys))
+        pos = _hash_slots(keys, self.n_bits)
+        while len(todo):
+            free = slots[pos] == -1
+            # one of the k-mers aimed at each free slot is written last and keeps it, the rest move on to the next slot
+            slots[pos[free]] = todo[free]
+            placed = slots[pos] == todo
+            todo, pos = todo[~placed], (pos[~placed] + 1) & (len(slots) - 1)
+        self.slots = slots
+
+    @classmethod
+    def from_kmers(cls, k, kmers, seq_ids, positions):
+        """
+            Builds the index from arrays of k-mers and the sequence and position of each
+        """
+        order = np.lexsort((positions, seq_ids, kmers))
+        keys, counts = np.unique(kmers[order], return_counts=True)
+        hit_starts = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(k, keys, hit_starts, seq_ids[order], positions[order])
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def n_hits(self):
+        """
+            Number of hits of each k-mer
+        """
+        return np.diff(self.hit_starts)
+
+    def lookup(self, kmers):
+        """
+            Returns the position of each k-mer in keys, or -1 for k-mers not in the index
+        """
+        kmers = np.asarray(kmers, dtype=np.uint64)
+        found = np.full(len(kmers), -1, dtype=np.int64)
+        todo = np.arange(len(kmers))
+        pos = _hash_slots(kmers, self.n_bits)
+        while len(todo):
+            slot = self.slots[pos]
+            used = slot >= 0
+            match = used & (self.keys[np.maximum(slot, 0)] == kmers[todo])
+            found[todo[match]] = slot[match]
+            # probing stops at a match or an empty slot
+            probe = used & ~match
+            todo, pos = todo[probe], (pos[probe] + 1) & (len(self.slots) - 1)
+        return found
+
+    def hits(self, key):
+        """
+            Returns the sequences and positions of the k-mer at a position in keys (see lookup)
+        """
+        hit_slice = slice(self.hit_starts[key], self.hit_starts[key+1])
+        return self.seq_ids[hit_slice], self.positions[hit_slice]
@@ -61,7 +61,7 @@ class TrimAndAlign:
         """
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         # prompts the user for username and password
-        usrName = raw_input("Server user name: ")
+        usrName = input("Server user name: ")
         psswrd = getpass.getpass("Server password: ")
         try:
             self.ssh.connect(self.server_address, username=usrName,
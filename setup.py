@@ -5,10 +5,11 @@ setup(name="data_processing",
       description="Data processing package for my code",
       author="jkurata",
       packages=["data_processing"],
+      python_requires=">=3.7",
       package_dir={"data_processing": "data_processing"},
       package_data={"data_processing": ["data/*.sam", "data/*.csv"]},
       include_package_data=True,
       install_requires=[
-           "matplotlib", "matplotlib-venn", "pandas", "paramiko", "pyodbc", "scipy", "sshtunnel"
+           "matplotlib", "matplotlib-venn", "numpy", "pandas", "paramiko", "pyodbc", "scipy", "sshtunnel"
       ],
       zip_safe=False)
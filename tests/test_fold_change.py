@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from data_processing.fold_change import compute_contrasts, fold_change, log_fold_change
+
+def _counts():
+    return pd.DataFrame({"gene": ["a", "b", "c"], "c1": [1, 2, 4], "c2": [3, 2, 4], "e1": [4, 8, 2]},
+                        index=["g1", "g2", "g3"])
+
+def test_fold_change_with_string_column():
+    df = _counts()
+    expected = df["e1"]/df[["c1", "c2"]].mean(axis=1)
+    assert np.allclose(fold_change(df, ["c1", "c2"], "e1"), expected)
+    assert np.allclose(fold_change(df, ["c1", "c2"], ["e1"])["e1"], expected)
+    assert np.allclose(log_fold_change(df, ["c1", "c2"], "e1"), np.log2(expected))
+
+def test_compute_contrasts_with_string_column():
+    df = _counts()
+    result = compute_contrasts(df, {"e1_vs_c": (["c1", "c2"], ["e1"])}, pseudocount=0)
+    assert np.allclose(result["e1_vs_c"], np.log2(df["e1"]/df[["c1", "c2"]].mean(axis=1)))
+
+def test_missing_column_raises_key_error():
+    df = _counts()
+    try:
+        fold_change(df, ["c1", "c3"], "e1")
+    except KeyError:
+        return
+    raise AssertionError("a missing column did not raise KeyError")